@@ -1,61 +1,168 @@
 ## This file allows the user to create a quantum circuit, apply common qubit gates, and collect the measurement result of the circuit with many shots. A diagram of the circuit can be created.
 
 import Algorithms
+import cmath
+import copy
+import math
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle, Ellipse
-from itertools import product as CartesianProduct
-import tkinter
-
-# Define common matrices used for gate operations. Since the rotation matrices need to receive angles, these matrices are packaged into a function instead of a dictionary, though this function essentially acts as a dictionary.
+from functools import lru_cache
+
+# matplotlib and tkinter are only needed to display the circuit diagram or the histogram of results. They are slow to import (and tkinter requires a display), so they are imported within the functions that use them rather than here. Running circuits without plotting never imports them.
+
+# Matrices of the gates without angles, and the projection matrices into the computational basis (used for constructing controlled-U gates and measurements). These never change, so they are built once when the module is imported, as double precision complex arrays so that they are never converted when combined with the circuit's state. The matrices are shared by every gate and are made read-only so that they cannot be modified by accident.
+STATIC_GATE_MATRICES = {
+    'I': np.eye(2),
+    'X': np.array([[0, 1],
+                   [1, 0]]),
+    'Y': np.array([[ 0, -1j],
+                   [1j,   0]]),
+    'Z': np.array([[1,  0],
+                   [0, -1]]),
+    'H': 1/np.sqrt(2)*np.array([[1,  1],
+                                [1, -1]]),
+    'S': np.array([[1,  0],
+                   [0, 1j]]),
+    'T': np.array([[1,                  0],
+                   [0, np.exp(1j*np.pi/4)]]),
+    'P0': np.array([[1, 0],
+                    [0, 0]]),
+    'P1': np.array([[0, 0],
+                    [0, 1]]),
+}
+for gateType in STATIC_GATE_MATRICES:
+    STATIC_GATE_MATRICES[gateType] = STATIC_GATE_MATRICES[gateType].astype(np.complex128)
+    STATIC_GATE_MATRICES[gateType].flags.writeable = False
+
+# Define common matrices used for gate operations. Since the rotation matrices need to receive angles, these matrices are packaged into a function instead of a dictionary, though this function essentially acts as a dictionary. Gates without angles return their matrix from STATIC_GATE_MATRICES. Phase and rotation matrices are filled in element by element. The angles are single numbers, so the trigonometric functions come from the math and cmath modules, which are much faster than numpy's for scalars, and each one is only evaluated once per matrix.
 def gateMatrix(gateType, angles=[0, 0, 0]):
+    matrix = STATIC_GATE_MATRICES.get(gateType)
+    if matrix is not None:
+        return matrix
+
     [theta, phi, lambd] = angles
-    if gateType == 'I':
-        return np.eye(2)
-    if gateType == 'X':
-        return np.array([[0, 1],
-                         [1, 0]])
-    if gateType == 'Y':
-        return np.array([[ 0, -1j],
-                         [1j,   0]])
-    if gateType == 'Z':
-        return np.array([[1,  0],
-                         [0, -1]])
-    if gateType == 'H':
-        return 1/np.sqrt(2)*np.array([[1,  1],
-                                      [1, -1]])
-    if gateType == 'S':
-        return np.array([[1,  0],
-                         [0, 1j]])
-    if gateType == 'T':
-        return np.array([[1,                  0],
-                         [0, np.exp(1j*np.pi/4)]])
+    matrix = np.empty((2, 2), dtype=np.complex128)
     if gateType == 'P':
-        return np.array([[1,                  0],
-                         [0, np.exp(1j*theta)]])
-    if gateType == 'RX':
-        return np.array([[    np.cos(theta/2), -1j*np.sin(theta/2)],
-                         [-1j*np.sin(theta/2),     np.cos(theta/2)]])
-    if gateType == 'RY':
-        return np.array([[np.cos(theta/2), -1*np.sin(theta/2)],
-                         [np.sin(theta/2),    np.cos(theta/2)]])
-    if gateType == 'RZ':
-        return np.array([[np.exp(-1j*theta/2),                  0],
-                         [                  0, np.exp(1j*theta/2)]])
-    if gateType == 'U':
-        return np.array([[np.cos(theta/2), -np.exp(1j*lambd)*np.sin(theta/2)],[np.exp(1j*phi)*np.sin(theta/2), np.exp(1j*(phi+lambd))*np.cos(theta/2)]])
-
-    # Projection matrices into the computational basis. Used for constructing controlled-U gates and measurements.
-    if gateType == 'P0':
-        return np.array([[1, 0],
-                         [0, 0]])
-    if gateType == 'P1':
-        return np.array([[0, 0],
-                         [0, 1]])
+        matrix[0, 0] = 1
+        matrix[0, 1] = 0
+        matrix[1, 0] = 0
+        matrix[1, 1] = cmath.exp(1j*theta)
+    elif gateType == 'RX':
+        cos = math.cos(theta/2)
+        sin = math.sin(theta/2)
+        matrix[0, 0] = cos
+        matrix[0, 1] = -1j*sin
+        matrix[1, 0] = -1j*sin
+        matrix[1, 1] = cos
+    elif gateType == 'RY':
+        cos = math.cos(theta/2)
+        sin = math.sin(theta/2)
+        matrix[0, 0] = cos
+        matrix[0, 1] = -1*sin
+        matrix[1, 0] = sin
+        matrix[1, 1] = cos
+    elif gateType == 'RZ':
+        phase = cmath.exp(1j*theta/2)
+        matrix[0, 0] = 1/phase
+        matrix[0, 1] = 0
+        matrix[1, 0] = 0
+        matrix[1, 1] = phase
+    elif gateType == 'U':
+        cos = math.cos(theta/2)
+        sin = math.sin(theta/2)
+        matrix[0, 0] = cos
+        matrix[0, 1] = -cmath.exp(1j*lambd)*sin
+        matrix[1, 0] = cmath.exp(1j*phi)*sin
+        matrix[1, 1] = cmath.exp(1j*(phi+lambd))*cos
+    else:
+        return None
+    return matrix
+
+# Apply a gate matrix to the qubits along the given axis of a state tensor (see run). The matrix is either a 2x2 gate on the qubit of that axis, or the 2^k x 2^k Kronecker product of gates on k consecutive axes starting at that axis. View the state as a stack of block x right matrices, where block is the size of the gate matrix and left and right are the numbers of amplitudes before and after the gate's axes, and multiply each by the gate matrix with a single call to matmul. The result keeps the state's axis order, so nothing needs to be transposed or moved back afterwards. matmul is slow for a stack of many small matrices, so when the gate's axes are among the last few, instead view the state as rows of block*right amplitudes and multiply them by the gate's matrix on all the axes after it (the Kronecker product of the gate and the identity). Optionally write the result into out, a contiguous array of the state's size that does not overlap the state, instead of a new array.
+def applyGate(state, matrix, axis, out=None):
+    shape = state.shape
+    block = matrix.shape[0]
+    numAxes = block.bit_length() - 1
+    left = int(np.prod(shape[:axis]))
+    right = int(np.prod(shape[axis+numAxes:]))
+    if block*right < 64:
+        if out is not None:
+            out = out.reshape(left, block*right)
+        return np.matmul(state.reshape(left, block*right), np.kron(matrix, np.eye(right, dtype=matrix.dtype)).T, out=out).reshape(shape)
+    if out is not None:
+        out = out.reshape(left, block, right)
+    return np.matmul(matrix, state.reshape(left, block, right), out=out).reshape(shape)
+
+# Phase and rotation matrices depend on their angles. These are built once per unique set of angles when a gate is added to the circuit, rather than every time the circuit is run. The same angles are often reused (e.g. pi/2**k within the QFT), so the matrices are cached and the trigonometric functions are only evaluated once per unique set of angles. The cache keeps at most the 1024 most recently used sets of angles, so circuits with many distinct angles (e.g. random rotations) do not keep every matrix in memory. The cached matrices are shared between gates and are made read-only.
+@lru_cache(maxsize=1024)
+def cachedGateMatrix(gateType, theta, phi=None, lambd=None):
+    matrix = gateMatrix(gateType, [theta, phi, lambd])
+    matrix.flags.writeable = False
+    return matrix
+
+# Angles that cannot be used as keys of the cache (e.g. 0-d numpy arrays) skip it and build their matrix directly.
+def angledGateMatrix(gateType, theta, phi=None, lambd=None):
+    try:
+        return cachedGateMatrix(gateType, theta, phi, lambd)
+    except TypeError:
+        matrix = gateMatrix(gateType, [theta, phi, lambd])
+        matrix.flags.writeable = False
+        return matrix
+
+# Contract a tensor network with numpy's einsum (see Circuit.unitary). operands is the alternating list of tensors and their legs accepted by einsum, and outputLegs are the legs of the result. Finding a good contraction order (the path) can take longer than the contraction itself, especially with optimize='optimal', and the path only depends on the shapes and legs of the tensors, not on their values. Circuits with the same structure (e.g. the same gates with different angles, as when tuning the angles of a circuit) therefore reuse the path found for the first one. EINSUM_PATHS stores the path of each network structure, keeping at most EINSUM_PATHS_SIZE of the most recently added structures.
+EINSUM_PATHS = {}
+EINSUM_PATHS_SIZE = 256
+def contractNetwork(operands, outputLegs, optimize='greedy'):
+    key = (tuple(np.shape(operand) if idx % 2 == 0 else tuple(operand) for idx, operand in enumerate(operands)), tuple(outputLegs), optimize)
+    path = EINSUM_PATHS.get(key)
+    if path is None:
+        path = np.einsum_path(*operands, outputLegs, optimize=optimize)[0]
+        if len(EINSUM_PATHS) >= EINSUM_PATHS_SIZE:
+            del EINSUM_PATHS[next(iter(EINSUM_PATHS))]
+        EINSUM_PATHS[key] = path
+    return np.einsum(*operands, outputLegs, optimize=path)
+
+# Placeholder angles for gates without phase or rotation angles. Angles are stored as tuples, which are never modified, so every such gate shares this one tuple instead of creating a new list of None's.
+NO_ANGLES = (None, None, None)
+
+# Convert the target(s) passed to a gate into a list of qubit indices. A single index (a python or numpy integer) is placed in a list; any other iterable of indices (e.g. a list, tuple, range, or numpy array) is converted into a list of python integers. A single python integer is by far the most common target, so check for it first with a direct class comparison, which is cheaper than isinstance.
+def targetList(targets):
+    if targets.__class__ is int:
+        return [targets]
+    if isinstance(targets, (int, np.integer)):
+        return [int(targets)]
+    return [int(target) for target in targets]
+
+# Map each position in a list of circuit positions (e.g. a qubit's gatePos) to its index in the list, so that the entry at a position can be looked up without searching the list. If a position appears more than once, the first index is kept, as with list.index.
+def positionIndex(positions):
+    return {position: idx for idx, position in reversed(list(enumerate(positions)))}
+
+# Create a box (a matplotlib Rectangle or Ellipse) for the circuit diagram. boxClass = Rectangle or Ellipse; xy = lower left corner of a Rectangle or center of an Ellipse; width, height = size of the box; zorder = layer order for rendering the box; style = keyword arguments for the box's colors and line width (e.g. fc, ec, lw). Creating a matplotlib patch parses its colors and line style every time, which takes most of the time spent formatting each gate. Every box with the same class and style is therefore copied from a template box that was created once, and only its position, size, and zorder are set. templates = dictionary storing each template with whether it is an Ellipse, which is positioned by its center instead of its corner. The templates pick up the matplotlib settings (rcParams) in effect when they are created, so display_circuit starts a new dictionary each time the circuit is displayed.
+def styledBox(templates, boxClass, xy, width, height, zorder, **style):
+    key = (boxClass, tuple(sorted(style.items())))
+    entry = templates.get(key)
+    if entry is None:
+        from matplotlib.patches import Ellipse, Rectangle
+        if not issubclass(boxClass, (Ellipse, Rectangle)):
+            raise ValueError('boxClass must be Rectangle or Ellipse.')
+        entry = (boxClass((0, 0), 1, 1, **style), issubclass(boxClass, Ellipse))
+        templates[key] = entry
+    [template, isEllipse] = entry
+    box = copy.copy(template)
+    if isEllipse:
+        box.set_center(xy)
+    else:
+        box.set_xy(xy)
+    box.set_width(width)
+    box.set_height(height)
+    box.set_zorder(zorder)
+    return box
 
 # Creates a qubit object, which stores all gates applied to the qubit, all connections the qubit is a part of (e.g. as a control for another target qubit's gate), and all algorithms that the qubit initiates. Note: while multiple qubits will be involved in an algorithm, only the highest index qubit inolved will receive the algorithm (and additional properties) appended to its lists. For circuit display purposes, it is only necessary to use one qubit to track algorithms, and the display code is written such that using the highest index qubit as the tracker is easiest.
 class Qubit:
 
+    # Declare the qubit's attributes up front so each qubit stores them in fixed slots instead of a per-instance dictionary. This saves memory for circuits with many qubits and speeds up the attribute lookups made every time a gate is added.
+    __slots__ = ('gates', 'gatePos', 'gateAngles', 'connections', 'connectTo', 'connectPos', 'algorithms', 'algQubits', 'algNumQubits', 'algStart', 'algEnd')
+
     def __init__(self):
 
         # gates = type of gate; gatePos = position of the gate along the circuit wire; gateAngles = theta, phi, lambd angles for phase and rotation gates
@@ -75,466 +182,389 @@ class Qubit:
         self.algStart = []
         self.algEnd = []
 
-        # The next available position along the qubit's circuit wire where a new gate can go. This is updated as more gates and algorithms are applied to the whole circuit and is used to determine gatePos, connectPos, and algStart above.
-        self.earliestPos = 1
-
 # Creates a classical bit object, which stores the bit's state (0 or 1) and all connections the bit is a part of (e.g. as storage for the result of measurement on a qubit).
 class Cbit:
 
+    # Declare the bit's attributes up front so each bit stores them in fixed slots instead of a per-instance dictionary.
+    __slots__ = ('state', 'connections', 'connectTo', 'connectPos')
+
     def __init__(self, state):
 
-        # state = state of the bit, i.e. 0 or 1; connections = type of connection; connectTo = qubit index that the current bit will connect to (such as as a measurement output storage); connectPos = position of the connection along the circuit wire
+        # state = state of the bit, i.e. 0 or 1 (after running the circuit, an array of the bit's state for every shot); connections = type of connection; connectTo = qubit index that the current bit will connect to (such as as a measurement output storage); connectPos = position of the connection along the circuit wire
         self.state = state
         self.connections = []
         self.connectTo = []
         self.connectPos = []
 
-        # The next available position along the bit's circuit wire where a new gate can go. This is updated as more gates and algorithms are applied to the whole circuit and is used to determine connectPos above.
-        self.earliestPos = 1
-
 # Creates an instance of a quantum circuit with a provided number of quantum bits and classical bits and allows the user
 # to apply qubit gates to the circuit
 class Circuit:
 
-    # Create the provided number of qubits and classical bits upon instance initialization
-    def __init__(self, numQubits):
+    # Create the provided number of qubits and classical bits upon instance initialization. Optionally choose the data type of the circuit state with dtype, and a seed for the random number generator used for measurements with seed (to get the same results every time the script is run). np.complex64 halves the memory and the time spent moving the state for large circuits, but the rounding error grows with the number of gates (roughly as sqrt(circuitLength) times single precision), so keep np.complex128 for deep circuits or circuits whose amplitudes nearly cancel.
+    def __init__(self, numQubits, dtype=np.complex128, seed=None):
 
         # Create a list of qubits. Each instance of the class Qubit will store the gates applied to the qubit. This is useful for creating a diagram of the circuit.
         self.numQubits = numQubits
         self.qubits = [Qubit() for qubit in range(numQubits)]
+
+        # The next available position along each qubit's circuit wire where a new gate can go, indexed by qubit. This is updated as more gates and algorithms are applied to the whole circuit and is used to determine each qubit's gatePos, connectPos, and algStart. The positions are kept together in a single array so that the earliest position over a range of qubits can be found (and updated) in one operation.
+        self.earliestPos = np.ones(numQubits, dtype=np.int64)
+
+        # The max earliest position over all qubits. Every change to earliestPos can only raise the max (or sets all qubits to the same position), so the max is updated as positions are reserved rather than recalculated over all qubits each time it is needed.
+        self.maxEarliestPos = 1
+
+        # The earliest position where a gate spanning multiple qubits (a controlled gate or SWAP) can go. A measurement only moves forward the earliest positions of its target and the qubits below it, so the qubits above it may still have room at the measurement's position. A spanning gate there would share the measurement's position (and row of the circuit's grid, see gate_grid), so every measurement raises this to the position after it.
+        self.spanEarliestPos = 1
         
-        # Form the state of all the qubits in the circuit. Assume all qubits are initialized in the |0> state, [1, 0]
-        self.state = np.array([1])
-        for qubit in self.qubits:
-            self.state = np.tensordot([1, 0], self.state, axes=0).reshape(len(self.state)*2, 1)
+        # The data type of the circuit's state: np.complex128 (double precision, the default) or np.complex64 (single precision). Single precision halves the memory of the state and the data moved every time a gate is applied, at the cost of precision.
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.complex64, np.complex128):
+            raise ValueError('dtype must be np.complex64 or np.complex128.')
+
+        # The state of all the qubits in the circuit is only allocated when it is first needed (see the state property below), so that circuits that are only displayed never allocate the 2^numQubits amplitudes.
+        self._state = None
         
+        # The random number generator used to sample measurement outcomes. numpy's Generator is faster than the legacy np.random functions and draws all the random numbers needed for a measurement over many shots in one call.
+        self.rng = np.random.default_rng(seed)
+
         # Create a list of classical bits, each initialized in the 0 state.
         self.numCbits = numQubits
         self.cbits = [Cbit(0) for cbit in range(numQubits)]
 
+        # The next available position along each classical bit's circuit wire where a new connection can go, indexed by bit. Like the qubits' earliestPos, the positions are kept together in a single array so that measure can find and update them over a range of bits in one operation. This is used to determine each bit's connectPos.
+        self.cbitEarliestPos = np.ones(self.numCbits, dtype=np.int64)
+
+        # A log of every gate and connection applied to the qubits, stored as separate lists for the qubit index, gate (or connection) type, circuit position, gate matrix (None for connections, barriers, measurements, and SWAPs), and whether the entry is part of a gate spanning multiple qubits or bits (controlled gates, SWAPs, and measurements) of each entry. The qubits store the same information for displaying the circuit, but keeping it together for the whole circuit lets run() place all the gates into the circuit's grid of positions at once (see gate_grid).
+        self.allGateQubit = []
+        self.allGateType = []
+        self.allGatePos = []
+        self.allGateMatrix = []
+        self.allGateSpanning = []
+
+        # The fused grid of gate types and matrices that run() simulates (see gate_grid and fuse_single_qubit_gates), stored with the length of the gate log it was built from. Gates are only ever added to the log, so the grid can be reused by later runs until the log grows.
+        self.fusedGrid = None
+
+    # The state of all the qubits in the circuit. If no state has been set yet, assume all qubits are initialized in the |0> state, [1, 0], so the state of the circuit is |00...0>: a column vector of length 2^numQubits with a 1 in the first entry and 0 everywhere else. Allocate it directly as complex so that applying complex gates does not need to convert it.
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = np.zeros((1 << self.numQubits, 1), dtype=self.dtype)
+            self._state[0, 0] = 1
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+
+    # Return the circuit to the |00...0> state (e.g. after initialize or run). The state is allocated again the next time it is needed.
+    def reset_state(self):
+        self._state = None
+
+        return self
+
+    # Add entries to the circuit's gate log (see __init__). The arguments are lists of equal length with the qubit index, gate type, circuit position, and gate matrix of each entry. Set spanning to True for the entries of a controlled gate, SWAP, or measurement.
+    def log_gates(self, qubitIdx, gateTypes, positions, matrices, spanning=False):
+        self.allGateQubit.extend(qubitIdx)
+        self.allGateType.extend(gateTypes)
+        self.allGatePos.extend(positions)
+        self.allGateMatrix.extend(matrices)
+        self.allGateSpanning.extend([spanning]*len(qubitIdx))
+
+    # Reserve the next circuit position on each target qubit for a single-qubit gate. Returns the reserved positions (in the same order as the targets) and increments the earliest position of every target. When each qubit appears only once in the targets, all positions are read and incremented in one operation; if a qubit is repeated, its gates are placed one after another.
+    def reserve_positions(self, targets):
+        if len(set(targets)) == len(targets):
+            positions = self.earliestPos[targets].tolist()
+            self.earliestPos[targets] += 1
+        else:
+            positions = []
+            for target in targets:
+                positions.append(int(self.earliestPos[target]))
+                self.earliestPos[target] += 1
+        if positions:
+            self.maxEarliestPos = max(self.maxEarliestPos, max(positions) + 1)
+        return positions
+
+    # Reserve a circuit position for a gate that spans multiple qubits (e.g. a controlled gate or SWAP). The gate is drawn as a vertical connection over every qubit between the lowest and highest qubit involved (inclusive), so its position is the max earliest position of all those qubits, and no earlier than the position after the last measurement (spanEarliestPos). Qubits outside of the span may already have gates at this position. The earliest position of every qubit is then moved to at least the position after the gate, so that no gate added later shares the position or is placed before it. Qubits that already have gates past the position keep their earliest position, so that new gates do not land on top of them. Returns the reserved position.
+    def reserve_span(self, qubitsInvolved):
+        lo = min(qubitsInvolved)
+        hi = max(qubitsInvolved)
+        position = max(int(self.earliestPos[lo:hi+1].max()), self.spanEarliestPos)
+        np.maximum(self.earliestPos, position + 1, out=self.earliestPos)
+        self.maxEarliestPos = max(self.maxEarliestPos, position + 1)
+        return position
+
+    # Reserve a circuit position spanning the whole circuit (e.g. a barrier, or the start or end of an algorithm). The position is the max earliest position of all qubits. The earliest position of all qubits is then updated to the position after it. Returns the reserved position.
+    def reserve_all(self):
+        position = self.maxEarliestPos
+        self.earliestPos[:] = position + 1
+        self.maxEarliestPos = position + 1
+        return position
+
     ## Gate functions below add their respective gates to the ongoing list of gates defined for each qubit. When running the circuit with run(), the gate lists are collected and applied to the circuit's initial state vector.
 
     ## SINGLE QUBIT GATES ##
 
+    # Add a single qubit gate to each target qubit. gate = gate type; targets = index of the target qubit, or a list of indices; angles = theta, phi, lambd angles of the gate (NO_ANGLES for gates without angles); matrix = 2x2 matrix of the gate. The matrix is built once, when the gate is added, so that it does not need to be rebuilt every time the circuit is run, and all targets share it. For each target, append the gate onto the running lists of the target qubit. Use each qubit's earliest position for the gate position; the earliest positions of all targets are reserved together.
+    def add_single_qubit_gate(self, gate, targets, angles, matrix):
+        targets = targetList(targets)
+        positions = self.reserve_positions(targets)
+        for target, position in zip(targets, positions):
+            qubit = self.qubits[target]
+            qubit.gates.append(gate)
+            qubit.gateAngles.append(angles)
+            qubit.gatePos.append(position)
+        self.log_gates(targets, [gate]*len(targets), positions, [matrix]*len(targets))
+
     # Pauli-X gate
     def X(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('X')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('X', targets, NO_ANGLES, gateMatrix('X'))
 
         return self
 
     # Pauli-Y gate
     def Y(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('Y')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('Y', targets, NO_ANGLES, gateMatrix('Y'))
 
         return self
 
     # Pauli-Z gate
     def Z(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('Z')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('Z', targets, NO_ANGLES, gateMatrix('Z'))
 
         return self
     
     # Hadamard gate
     def H(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('H')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('H', targets, NO_ANGLES, gateMatrix('H'))
 
         return self
     
     # Phase gate
     def S(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('S')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('S', targets, NO_ANGLES, gateMatrix('S'))
 
         return self
     
     # pi/8 gate
     def T(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('T')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_single_qubit_gate('T', targets, NO_ANGLES, gateMatrix('T'))
 
         return self
     
     # phase gate
     def P(self, targets, theta):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('P')
-            angles = [theta, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). Store theta and None's for phi and lambd.
+        self.add_single_qubit_gate('P', targets, (theta, None, None), angledGateMatrix('P', theta))
 
         return self
 
     # R_X gate
     def RX(self, targets, theta):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('RX')
-            angles = [theta, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        # Add the gate to each target qubit (see add_single_qubit_gate). Store theta and None's for phi and lambd.
+        self.add_single_qubit_gate('RX', targets, (theta, None, None), angledGateMatrix('RX', theta))
 
         return self
     
     # R_Y gate
     def RY(self, targets, theta):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
+        # Add the gate to each target qubit (see add_single_qubit_gate). Store theta and None's for phi and lambd.
+        self.add_single_qubit_gate('RY', targets, (theta, None, None), angledGateMatrix('RY', theta))
 
-        # For each target, append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('RY')
-            angles = [theta, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        return self
 
     # R_Z gate
     def RZ(self, targets, theta):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
+        # Add the gate to each target qubit (see add_single_qubit_gate). Store theta and None's for phi and lambd.
+        self.add_single_qubit_gate('RZ', targets, (theta, None, None), angledGateMatrix('RZ', theta))
 
-        # For each target, append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('RZ')
-            angles = [theta, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        return self
 
     # U gate
     def U(self, targets, theta, phi, lambd):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
+        # Add the gate to each target qubit (see add_single_qubit_gate). Store theta, phi, and lambd.
+        self.add_single_qubit_gate('U', targets, (theta, phi, lambd), angledGateMatrix('U', theta, phi, lambd))
 
-        # For each target, append the gate onto the running list of gates for the target qubit. Append theta, phi, and lambd. Use the qubit's earliest position for the gate position, then increment the earliest position for future gates.
-        for target in targets:
-            self.qubits[target].gates.append('U')
-            angles = [theta, phi, lambd]
-            self.qubits[target].gateAngles.append(angles)
-            self.qubits[target].gatePos.append(self.qubits[target].earliestPos)
-            self.qubits[target].earliestPos += 1
+        return self
 
     ## TWO QUBIT GATES ##
 
-    # Controlled-X gate
-    def CX(self, controls, target):
+    # Add a controlled gate to the target qubit. gate = type of the target's gate; controls = list of control qubit indices; target = index of the target qubit; angles = theta, phi, lambd angles of the target's gate (NO_ANGLES for gates without angles); matrix = 2x2 matrix of the target's gate. Reserve the gate position spanning the target and controls (see reserve_span); this position is used for both the target and controls. Append the gate onto the running lists of the target qubit. For each control qubit, append a control, 'C', to the list of connections, the index of the target to the list of connectTo, and the gate position to the list of connectPos.
+    def add_controlled_gate(self, gate, controls, target, angles, matrix):
+        position = self.reserve_span([*controls, target])
+
+        qubit = self.qubits[target]
+        qubit.gates.append(gate)
+        qubit.gateAngles.append(angles)
+        qubit.gatePos.append(position)
+        self.log_gates([target], [gate], [position], [matrix], spanning=True)
 
-        # Append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('X')
-        angles = [None, None, None]
-        self.qubits[target].gateAngles.append(angles)
         for control in controls:
             self.qubits[control].connections.append('C')
             self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
             self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        self.log_gates(controls, ['C']*len(controls), [position]*len(controls), [None]*len(controls), spanning=True)
+
+    # Controlled-X gate
+    def CX(self, controls, target):
+
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_controlled_gate('X', controls, target, NO_ANGLES, gateMatrix('X'))
 
         return self
     
     # Controlled-Y gate
     def CY(self, controls, target):
 
-        # Append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('Y')
-        angles = [None, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_controlled_gate('Y', controls, target, NO_ANGLES, gateMatrix('Y'))
 
         return self
     
     # Controlled-Z gate
     def CZ(self, controls, target):
 
-        # Append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('Z')
-        angles = [None, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). No angles are needed, so NO_ANGLES is used as a placeholder.
+        self.add_controlled_gate('Z', controls, target, NO_ANGLES, gateMatrix('Z'))
 
         return self
     
     # Controlled-P gate
     def CP(self, controls, target, theta):
 
-        # Append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('P')
-        angles = [theta, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). Store theta and None's for phi and lambd.
+        self.add_controlled_gate('P', controls, target, (theta, None, None), angledGateMatrix('P', theta))
 
         return self
 
     # Controlled-RX gate
     def CRX(self, controls, target, theta):
 
-        # Append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('RX')
-        angles = [theta, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). Store theta and None's for phi and lambd.
+        self.add_controlled_gate('RX', controls, target, (theta, None, None), angledGateMatrix('RX', theta))
 
         return self
 
         # Controlled-RY gate
     def CRY(self, controls, target, theta):
 
-        # Append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('RY')
-        angles = [theta, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). Store theta and None's for phi and lambd.
+        self.add_controlled_gate('RY', controls, target, (theta, None, None), angledGateMatrix('RY', theta))
 
         return self
 
     # Controlled-RZ gate
     def CRZ(self, controls, target, theta):
 
-        # Append the gate onto the running list of gates for the target qubit. Append theta and None's for phi and lambd. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('RZ')
-        angles = [theta, None, None]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). Store theta and None's for phi and lambd.
+        self.add_controlled_gate('RZ', controls, target, (theta, None, None), angledGateMatrix('RZ', theta))
 
         return self
 
         # Controlled-U gate
     def CU(self, controls, target, theta, phi, lambd):
 
-        # Append the gate onto the running list of gates for the target qubit. Append theta, phi, and lambd. Append a control, 'C', to the list of connections and the index of the target to the list of connectTo for the control qubits.
-        self.qubits[target].gates.append('U')
-        angles = [theta, phi, lambd]
-        self.qubits[target].gateAngles.append(angles)
-        for control in controls:
-            self.qubits[control].connections.append('C')
-            self.qubits[control].connectTo.append(target)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(min(controls), target), max(max(controls), target)+1)]
-        position = max(earliestPositions)
-        self.qubits[target].gatePos.append(position)
-        for control in controls:
-            self.qubits[control].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Add the gate to the target qubit, controlled by the control qubits (see add_controlled_gate). Store theta, phi, and lambd.
+        self.add_controlled_gate('U', controls, target, (theta, phi, lambd), angledGateMatrix('U', theta, phi, lambd))
 
         return self
 
     # SWAP gate
     def SWAP(self, target1, target2):
 
-        # Append the gate onto the running list of gates for the target qubit (which we'll use target2 as for consistency with controlled gates). No angles are needed, so a list of None's are appended as a placeholder. Append the connection type onto the running list of connections for the control qubit (target1) and which qubit it is controlling (target2).
-        self.qubits[target2].gates.append('SWAP')
-        angles = [None, None, None]
-        self.qubits[target2].gateAngles.append(angles)
-        self.qubits[target1].connections.append('SWAP')
-        self.qubits[target1].connectTo.append(target2)
-
-        # Get the earliest possible gate position within the circuit for each qubit between the targets (inclusive). The max of this list will be used for the gate position for both targets. Then increment the earliest position for all qubits.
-        earliestPositions = [self.qubits[idx].earliestPos for idx in range(min(target1, target2), max(target1, target2)+1)]
-        position = max(earliestPositions)
-        self.qubits[target2].gatePos.append(position)
-        self.qubits[target1].connectPos.append(position)
-        for qubit in self.qubits:
-            qubit.earliestPos = position + 1
+        # Append the gate onto the running list of gates for the target qubit (which we'll use target2 as for consistency with controlled gates). No angles are needed, so the shared tuple of None's, NO_ANGLES, is appended as a placeholder. Append the connection type onto the running list of connections for the control qubit (target1) and which qubit it is controlling (target2).
+        qubit1 = self.qubits[target1]
+        qubit2 = self.qubits[target2]
+        qubit2.gates.append('SWAP')
+        qubit2.gateAngles.append(NO_ANGLES)
+        qubit1.connections.append('SWAP')
+        qubit1.connectTo.append(target2)
+
+        # Reserve the gate position spanning both targets (see reserve_span). This position will be used for both targets.
+        position = self.reserve_span([target1, target2])
+        qubit2.gatePos.append(position)
+        qubit1.connectPos.append(position)
+        self.log_gates([target2, target1], ['SWAP', 'SWAP'], [position, position], [None, None], spanning=True)
 
         return self
     
     ## OTHER CIRCUIT FUNCTIONS ##
 
+    # Set the initial state of each qubit instead of |0>. qubitStates is a list with the state vector of each qubit, starting with qubit 0, e.g. [[0, 1], [1/np.sqrt(2), 1/np.sqrt(2)]] for qubit 0 in |1> and qubit 1 in |+>. The circuit's state is the tensor product of the qubit states. Build it one qubit at a time with an outer product, flattening the result into a vector after each qubit. Each qubit is placed in front of the qubits before it, so qubit 0 is the least significant bit of the state's index.
+    def initialize(self, qubitStates):
+
+        if len(qubitStates) != self.numQubits:
+            raise ValueError('A state must be provided for each of the %i qubits.' % self.numQubits)
+
+        state = np.ones(1, dtype=self.dtype)
+        for qubitState in qubitStates:
+            state = np.multiply.outer(np.asarray(qubitState, dtype=self.dtype), state).reshape(-1)
+        self.state = state.reshape(-1, 1)
+
+        return self
+
     # Add a barrier to the circuit. The state vector does not change. A barrier is purely for visual purposes when displaying the circuit to divide the circuit into segments.
     def barrier(self):
 
         # Append a barrier to the highest index qubit. Similar to tracking algorithms, only one qubit needs to act as the tracker, and the cirucit display code is written such that using the last qubit is easiest. The max earliest position for all qubits is the position of the barrier. All qubits' earliest position is then updated to the position after the barrier.
-        self.qubits[-1].gates.append('B')
-        angles = [None, None, None]
-        self.qubits[-1].gateAngles.append(angles)
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
-        self.qubits[-1].gatePos.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
+        tracker = self.qubits[-1]
+        tracker.gates.append('B')
+        tracker.gateAngles.append(NO_ANGLES)
+        earliestPosition = self.reserve_all()
+        tracker.gatePos.append(earliestPosition)
+        self.log_gates([self.numQubits-1], ['B'], [earliestPosition], [None])
 
     # Measure a qubit and store the result in a classical bit. This is a measurement in the computational basis (projection into the 0 or 1 state).
     def measure(self, targets):
 
-        # If only one target is provided, place the index in a list. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
-        if type(targets) == int:
-            targets = [targets]
-
-        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so a list of None's are appended as a placeholder. Append an output, 'O', to the list of connections and the index of the target to the list of connectTo for the classical bit that will store the measurement outcome. For simplicity, the classical bit with the same index as the target qubit will be used.
-        for target in targets:
-            self.qubits[target].gates.append('M')
-            angles = [None, None, None]
-            self.qubits[target].gateAngles.append(angles)
-            self.cbits[target].connections.append('O')
-            self.cbits[target].connectTo.append(target)
-
-            # Get the earliest possible gate position within the circuit for each qubit between the target and control (inclusive). The max of this list will be used for the gate position for both the target and control. Then increase the earliest position for all qubits between the target and control (inclusive).
-            earliestPositions = [qubit.earliestPos for qubit in self.qubits[target:]]
-            for cbit in self.cbits[:target]:
-                earliestPositions.append(cbit.earliestPos)
-            position = max(earliestPositions)
-            self.qubits[target].gatePos.append(position)
-            self.cbits[target].connectPos.append(position)
-            for qubit in self.qubits[target:]:
-                qubit.earliestPos = position + 1
-            for cbit in self.cbits:
-                cbit.earliestPos = position + 1
+        # Convert the target(s) into a list of qubit indices. This is to remain consistent with situations where lists of targets are provided and avoids an error in the code below.
+        targets = targetList(targets)
+
+        # Get the position of each measurement. A measurement's connection runs from the target qubit down through every qubit below it and every classical bit above the target's bit, so its position is the max of the earliest positions over those qubits and bits. Afterwards, the earliest position of all of those qubits and every classical bit is the position after the measurement, so each measurement is at least one position after the previous one. The qubits above the target keep their earliest positions, so single qubit gates can still be placed on them at the measurement's position; later controlled gates and SWAPs are kept after it by spanEarliestPos (see reserve_span). Calculate the positions of all the targets at once: startPositions is each target's position from the qubits' and bits' earliest positions before any of the measurements (the max of earliestPos from the target down, and of cbitEarliestPos above the target's bit), and each position is then the max of its startPosition and the previous position + 1. Subtracting each measurement's index turns this into a running max.
+        numTargets = len(targets)
+        if numTargets == 0:
+            return self
+        targetIdx = np.array(targets, dtype=np.int64)
+        startPositions = np.maximum.accumulate(self.earliestPos[::-1])[::-1][targetIdx]
+        cbitPrefixMax = np.maximum.accumulate(self.cbitEarliestPos)
+        hasCbitsAbove = targetIdx > 0
+        startPositions[hasCbitsAbove] = np.maximum(startPositions[hasCbitsAbove], cbitPrefixMax[targetIdx[hasCbitsAbove] - 1])
+        measureIdx = np.arange(numTargets)
+        positions = (np.maximum.accumulate(startPositions - measureIdx) + measureIdx).tolist()
+
+        # For each target, append the gate onto the running list of gates for the target qubit. No angles are needed, so the shared tuple of None's, NO_ANGLES, is appended as a placeholder. Append an output, 'O', to the list of connections and the index of the target to the list of connectTo for the classical bit that will store the measurement outcome. For simplicity, the classical bit with the same index as the target qubit will be used. Increase the earliest position of the target and every qubit below it to the position after the measurement.
+        for target, position in zip(targets, positions):
+            qubit = self.qubits[target]
+            cbit = self.cbits[target]
+            qubit.gates.append('M')
+            qubit.gateAngles.append(NO_ANGLES)
+            qubit.gatePos.append(position)
+            cbit.connections.append('O')
+            cbit.connectTo.append(target)
+            cbit.connectPos.append(position)
+            self.earliestPos[target:] = position + 1
+        self.log_gates(targets, ['M']*numTargets, positions, [None]*numTargets, spanning=True)
+
+        # The last measurement is at the highest position. Increase the earliest position of every classical bit, and of any later controlled gate or SWAP, to the position after it.
+        self.maxEarliestPos = max(self.maxEarliestPos, positions[-1] + 1)
+        self.cbitEarliestPos[:] = positions[-1] + 1
+        self.spanEarliestPos = positions[-1] + 1
 
         return self
     
@@ -565,19 +595,15 @@ class Circuit:
         self.qubits[algTracker].algNumQubits.append(numQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the starting point for the algorithm. Append this value to algStart for the tracker. Increase the earliest position for all qubits in the circuit to the algStart + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algStart.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         # Apply the algorithn.
         Algorithms.DeutschJozsa(self, oracle, oracleType, algQubits, constantOracleOutput, balancedInputFlips)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the end point for the algorithm. Append this value to algEnd for the tracker. Increase the earliest position for all qubits in the circuit to the algEnd + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algEnd.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         return
     
@@ -598,19 +624,15 @@ class Circuit:
         self.qubits[algTracker].algNumQubits.append(numQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the starting point for the algorithm. Append this value to algStart for the tracker. Increase the earliest position for all qubits in the circuit to the algStart + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algStart.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         # Apply the algorithm. See Algorithms.py.
         Algorithms.QFT(self, algQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the end point for the algorithm. Append this value to algEnd for the tracker. Increase the earliest position for all qubits in the circuit to the algEnd + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algEnd.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         return
     
@@ -631,19 +653,15 @@ class Circuit:
         self.qubits[algTracker].algNumQubits.append(numQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the starting point for the algorithm. Append this value to algStart for the tracker. Increase the earliest position for all qubits in the circuit to the algStart + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algStart.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         # Apply the algorithm. See Algorithms.py.
         Algorithms.IQFT(self, algQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the end point for the algorithm. Append this value to algEnd for the tracker. Increase the earliest position for all qubits in the circuit to the algEnd + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algEnd.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         return
     
@@ -666,19 +684,15 @@ class Circuit:
         self.qubits[algTracker].algNumQubits.append(numQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the starting point for the algorithm. Append this value to algStart for the tracker. Increase the earliest position for all qubits in the circuit to the algStart + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algStart.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         # Apply the algorithm. See Algorithms.py.
         Algorithms.QPE(self, lambd, algQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the end point for the algorithm. Append this value to algEnd for the tracker. Increase the earliest position for all qubits in the circuit to the algEnd + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algEnd.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
         
         return
     
@@ -696,47 +710,56 @@ class Circuit:
         self.qubits[algTracker].algNumQubits.append(numQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the starting point for the algorithm. Append this value to algStart for the tracker. Increase the earliest position for all qubits in the circuit to the algStart + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algStart.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         # Apply the algorithm.
         Algorithms.Grover(self, oracle, algQubits)
 
         # Get the earliest position for all qubits in the circuit (not just the algorithm qubits). The max will be used as the end point for the algorithm. Append this value to algEnd for the tracker. Increase the earliest position for all qubits in the circuit to the algEnd + 1.
-        earliestPosition = max([qubit.earliestPos for qubit in self.qubits])
+        earliestPosition = self.reserve_all()
         self.qubits[algTracker].algEnd.append(earliestPosition)
-        for qubit in self.qubits:
-            qubit.earliestPos = earliestPosition + 1
 
         return
 
-    # Calculate the dimensions in data coordinates of the boxes used to represent gates when displaying the circuit. xy = center of the box, in data coordinates; sizeX (sizeY) = total pixel size of the box's text in the X (Y) axis, accounting for number of letters in the text (X) and number of lines of text (Y); ax = figure axis.
-    def gate_size(self, xy, sizeX, sizeY, ax):
+    # Calculate the dimensions in data coordinates of the boxes used to represent gates when displaying the circuit. xy = center of the box, in data coordinates; sizeX (sizeY) = total pixel size of the box's text in the X (Y) axis, accounting for number of letters in the text (X) and number of lines of text (Y); ax = figure axis; transforms = transforms from data to display coordinates and back, along with a dictionary of the box sizes already calculated with them and a dictionary of box templates (optional, see styledBox).
+    def gate_size(self, xy, sizeX, sizeY, ax, transforms=None):
+
+        # Get the transforms between data and display coordinates, if they were not provided. Building the axis' transform and its inverse is slow, so display_circuit freezes both once and passes them to every gate.
+        if transforms is None:
+            dataToDisplay = ax.transData.frozen()
+            transforms = (dataToDisplay, dataToDisplay.inverted(), {}, {})
+        dataToDisplay, displayToData, boxSizes, _ = transforms
 
-        # Separate the center x and y coordinates. Convert them to display coordinates.
+        # The axis' transform is linear, so the width and height of a box in data coordinates only depend on the size of its text, not on where the box is. Most gates in a circuit share a few text sizes (e.g. every H, X, and control), so calculate each size's width and height once and store them in boxSizes.
         xData, yData = xy
-        xDisplay, yDisplay = ax.transData.transform([xData,yData])
+        if (sizeX, sizeY) not in boxSizes:
 
-        # The width (height) in display coordinates will be 2 times the text width (height).
-        wDisplay = sizeX*2
-        hDisplay = sizeY*2
+            # Convert the center coordinates to display coordinates.
+            xDisplay, yDisplay = dataToDisplay.transform(xy)
 
-        # Calculate the minimum x and y coordinates of the box in display coordinates (lower left corner). This is the center is half of the width (height) for the x (y) coordinate. Then convert these to data coordinates.
-        xMinDisplay, yMinDisplay = xDisplay-wDisplay/2, yDisplay-hDisplay/2
-        xMinData, yMinData = ax.transData.inverted().transform((xMinDisplay,yMinDisplay))
+            # The width (height) in display coordinates will be 2 times the text width (height).
+            wDisplay = sizeX*2
+            hDisplay = sizeY*2
 
-        # Calculate the maximum x and y coordinates by adding the width (height) to the minimum x (y) coordinate in display coordinates and converting to data coordinates. Then subtract the max and min for x (y) to get the width (height) in data coordinates.
-        xMaxData, yMaxData = ax.transData.inverted().transform((xMinDisplay+wDisplay,yMinDisplay+hDisplay))
-        wData = xMaxData - xMinData
-        hData = yMaxData - yMinData
+            # Calculate the minimum x and y coordinates of the box in display coordinates (lower left corner), which are half of the width (height) below the center, and the maximum x and y coordinates by adding the width (height). Convert both corners to data coordinates together. Then subtract the max and min for x (y) to get the width (height) in data coordinates.
+            xMinDisplay, yMinDisplay = xDisplay-wDisplay/2, yDisplay-hDisplay/2
+            [[xMinData, yMinData], [xMaxData, yMaxData]] = displayToData.transform([(xMinDisplay,yMinDisplay), (xMinDisplay+wDisplay,yMinDisplay+hDisplay)])
+            boxSizes[sizeX, sizeY] = (xMaxData - xMinData, yMaxData - yMinData)
+        wData, hData = boxSizes[sizeX, sizeY]
+
+        # The lower left corner of the box is half of the width (height) below the center in the x (y) coordinate.
+        xMinData, yMinData = xData - wData/2, yData - hData/2
 
         # Return the lower left box coordinates, width, and height, all in data coordinates.
         return [(xMinData, yMinData), wData, hData]
 
-    # Assign the gate label, box parameters, and connection parameters to be used for displaying the circuit. gate = gate type; xy = center of the box, in data coordinates; ax = figure axis; zorder = layer order for rendering the boxes in the circuit diagram; angles = theta, phi, lambd, when needed for phase and rotation gates.
-    def format_gate(self, gate, xy, ax, zorder, angles=[0, 0, 0]):
+    # Assign the gate label, box parameters, and connection parameters to be used for displaying the circuit. gate = gate type; xy = center of the box, in data coordinates; ax = figure axis; zorder = layer order for rendering the boxes in the circuit diagram; angles = theta, phi, lambd, when needed for phase and rotation gates; transforms = transforms from data to display coordinates and back, with their box sizes and box templates (optional, see gate_size).
+    def format_gate(self, gate, xy, ax, zorder, angles=[0, 0, 0], transforms=None):
+        from matplotlib.patches import Rectangle, Ellipse
+
+        # Get the box templates collected while displaying the circuit (see styledBox), or start new ones if no transforms were provided.
+        boxTemplates = {} if transforms is None else transforms[3]
 
         # User-defined phase gate
         if gate == 'P':
@@ -757,10 +780,10 @@ class Circuit:
             textHeight = textSize*2
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Since this is not a connection, leave the arrow properties blank.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
             arrowprops=dict()
 
         # Rotation gates
@@ -783,10 +806,10 @@ class Circuit:
             textHeight = textSize*2
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Since this is not a connection, leave the arrow properties blank.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
             arrowprops=dict()
 
         # U gates
@@ -814,10 +837,10 @@ class Circuit:
             textHeight = textSize*2
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Since this is not a connection, leave the arrow properties blank.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
             arrowprops=dict()
 
         # SWAP gates
@@ -830,10 +853,10 @@ class Circuit:
             textHeight = textSize
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Use a solid black line for the connection to the swapped qubit.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight, fc='none', ec='none', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight, fc='none', ec='none', zorder=zorder)
             arrowprops=dict(arrowstyle="-", edgecolor='black', linewidth=2)
 
         # Controls in controlled-gates
@@ -846,10 +869,10 @@ class Circuit:
             symHeight = textSize
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, symWidth, symHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, symWidth, symHeight, ax, transforms)
 
             # Create the circle object with appropriate style parameters. Use a solid black line for the connection to the target qubit.
-            gateBox = Ellipse(xy, gateWidth, gateHeight, fc='black', ec='black', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Ellipse, xy, gateWidth, gateHeight, fc='black', ec='black', zorder=zorder)
             arrowprops=dict(arrowstyle="-", edgecolor='black', linewidth=2)
 
         # Output in measurement gates
@@ -862,10 +885,10 @@ class Circuit:
             symHeight = textSize
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, symWidth, symHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, symWidth, symHeight, ax, transforms)
 
             # Create the circle object with appropriate style parameters. Use a solid black line with an arrow that points to the circle to represent the measurement output from the qubit being stored in the classical bit.
-            gateBox = Ellipse(xy, gateWidth, gateHeight, fc='none', ec='black', lw=2, zorder=zorder)
+            gateBox = styledBox(boxTemplates, Ellipse, xy, gateWidth, gateHeight, fc='none', ec='black', lw=2, zorder=zorder)
             arrowprops=dict(arrowstyle="<|-", edgecolor='black', linewidth=2)
 
         # Barriers
@@ -878,10 +901,10 @@ class Circuit:
             barrierHeight = textSize
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, barrierWidth, barrierHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, barrierWidth, barrierHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Since gateHeight would assume only one qubit has the barrier, add the total number of qubits in the circuit (-1 since gateHeight already includes one qubit) to stretch the barrier over the entire circuit. Since this is not a connection, leave the arrow properties blank.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight+self.numQubits-1, fc='gray', ec='none', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight+self.numQubits-1, fc='gray', ec='none', zorder=zorder)
             arrowprops=dict()
 
         # Gates with no rotation angles.
@@ -894,16 +917,20 @@ class Circuit:
             textHeight = textSize
 
             # Get the gate coordinates, width, and height in data coordinates using the function gate_size.
-            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax)
+            gateXY, gateWidth, gateHeight = self.gate_size(xy, textWidth, textHeight, ax, transforms)
 
             # Create the box object with appropriate style parameters. Since this is not a connection, leave the arrow properties blank.
-            gateBox = Rectangle(gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
+            gateBox = styledBox(boxTemplates, Rectangle, gateXY, gateWidth, gateHeight, fc='white', ec='black', zorder=zorder)
             arrowprops=dict()
         
         return [gateLabel, textSize, arrowprops, gateBox]
     
-    # Assign the algorithm label and box parameters to be used for displaying the circuit. algorithm = algorithm type; numQubits = number of qubits involved in the algorithm; xy = center of the box, in data coordinates; ax = figure axis; zorder = layer order for rendering the boxes in the circuit diagram.
-    def format_algorithm(self, algorithm, numQubits, xy, ax, zorder):
+    # Assign the algorithm label and box parameters to be used for displaying the circuit. algorithm = algorithm type; numQubits = number of qubits involved in the algorithm; xy = center of the box, in data coordinates; ax = figure axis; zorder = layer order for rendering the boxes in the circuit diagram; transforms = transforms from data to display coordinates and back, with their box sizes and box templates (optional, see gate_size).
+    def format_algorithm(self, algorithm, numQubits, xy, ax, zorder, transforms=None):
+        from matplotlib.patches import Rectangle
+
+        # Get the box templates collected while displaying the circuit (see styledBox), or start new ones if no transforms were provided.
+        boxTemplates = {} if transforms is None else transforms[3]
 
         # Algorithm label: algorithm type. The box width is the text size times the character length of the algorithm type, with a factor of 0.5 determined heuristically for appropriate padding. The box height is just the text size since only a single line is used.
         algLabel = algorithm
@@ -912,16 +939,19 @@ class Circuit:
         boxHeight = textSize
 
         # Get the algorithm box coordinates, width, and height in data coordinates using the function gate_size.
-        algXY, algWidth, algHeight = self.gate_size(xy, boxWidth, boxHeight, ax)
+        algXY, algWidth, algHeight = self.gate_size(xy, boxWidth, boxHeight, ax, transforms)
 
         # Create the box object with appropriate style parameters. Since algHeight would assume only one qubit has the barrier, add the total number of qubits involved in the algorithm (-1 since algHeight already includes one qubit) to stretch the box over all qubits involved. Since this is not a connection, leave the arrow properties blank.
-        algBox = Rectangle(algXY, algWidth, algHeight+numQubits-1, fc='white', ec='black', zorder=zorder)
+        algBox = styledBox(boxTemplates, Rectangle, algXY, algWidth, algHeight+numQubits-1, fc='white', ec='black', zorder=zorder)
         arrowprops=dict()
 
         return [algLabel, textSize, arrowprops, algBox]
 
     # Create a figure showing a diagram of the circuit.
     def display_circuit(self):
+        import tkinter
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import PatchCollection
 
         # Get the screen size and dpi to scale the figure window.
         win = tkinter.Tk()
@@ -934,33 +964,20 @@ class Circuit:
         fig = plt.figure(figsize=(screenWidth/dpi*0.75, screenHeight/dpi*0.75))
         ax = fig.add_subplot(111)
 
-        # Get the circuit length. For each qubit, get the last gate position applied to the qubit. Update circuitLength to be the highest gate position in the circuit.
-        circuitLength = 0
-        for qubit in self.qubits:
-            if len(qubit.gates) > 0:
-                lastPos = qubit.gatePos[-1]
-                if lastPos > circuitLength:
-                    circuitLength = lastPos
-        
-        # Algorithms will be displayed as simple boxes without showing the individual gates comprising the algorithm (for simplicity; use Algorithms.py directly to display the individial gates). Calculate a circuit length offset to account for gates applied after algorithms being shifted to earlier positions in the diagram. For each qubit, get the number of positions taken up by each algorithm that the qubit is a tracker for. Add the number to the running total.
-        circuitLengthOffset = 0
-        prevAlgEnd = 0
-
-        # Loop over the qubits starting at the highest index so that when there is an algorithm within an algorithm, only the offset for the outside algorithm will be counted.
-        for qubit in reversed(self.qubits):
-            for Aidx, algorithm in enumerate(qubit.algorithms):
-
-                # If algStart of the current algorithm is less than the previous algorithm's algEnd, then this is an algorithm within another algorithm. Skip over it since we only want the offset from the outside algorithm.
-                if qubit.algStart[Aidx] < prevAlgEnd:
-                    continue
-                
-                else:
+        # Get the circuit length: the highest gate position in the circuit. Every gate, connection, and barrier is in the circuit's gate log (see __init__), so this is the max of its positions.
+        circuitLength = max(self.allGatePos, default=0)
 
-                    # Subtract the algStart from the algEnd to get the offset for the current algorithm.
-                    circuitLengthOffset += qubit.algEnd[Aidx]-qubit.algStart[Aidx]
+        # Algorithms will be displayed as simple boxes without showing the individual gates comprising the algorithm (for simplicity; use Algorithms.py directly to display the individial gates). Calculate a circuit length offset to account for gates applied after algorithms being shifted to earlier positions in the diagram: the total number of positions taken up by the algorithms. Gather the start and end positions of every algorithm from the qubits tracking them, ordered by start.
+        algStarts = np.array([start for qubit in self.qubits for start in qubit.algStart], dtype=np.int64)
+        algEnds = np.array([end for qubit in self.qubits for end in qubit.algEnd], dtype=np.int64)
+        algOrder = np.argsort(algStarts, kind='stable')
+        algStarts = algStarts[algOrder]
+        algEnds = algEnds[algOrder]
 
-                    # Store the end position of the current algorithm to check for algorithms within this algorithm on subsequent loops.
-                    prevAlgEnd = qubit.algEnd[Aidx]
+        # Algorithms are either one after another or one within another (e.g. the IQFT within QPE). An algorithm that starts before the end of an earlier algorithm is within it, so skip over it since we only want the offset from the outside algorithm. Compare each start with the latest end of the algorithms before it, and add up the end minus the start of the outside algorithms.
+        prevAlgEnds = np.concatenate(([0], np.maximum.accumulate(algEnds)[:-1]))
+        outside = algStarts >= prevAlgEnds
+        circuitLengthOffset = int((algEnds[outside] - algStarts[outside]).sum())
 
         # Set some style parameters. Start the bit labels at x=0. The diagram will display the x axis from 0 to the circuit length, with the offset subtracted out. Along the y axis, qubits will be placed at the negative of their index so that the lowest index qubit will be at the top of the diagram. Classical bits will be below the qubits. Set the y axis to be from the negative of the total number of qubits and classical bits to 1, which prevents a buffer with the top qubit.
         bitLabelPosition = 0
@@ -968,126 +985,153 @@ class Circuit:
         ax.set(xlim=(0, circuitLength-circuitLengthOffset+1), ylim=(-1*(self.numQubits+self.numCbits), 1))
         ax.set_axis_off()
 
+        # Get the transforms between data and display coordinates once, now that the axis limits are set, and pass them to format_gate and format_algorithm for sizing the gate boxes. Freezing the axis' transform turns it into a single affine transform that is cheap to apply and invert. The empty dictionaries collect the box sizes calculated with them (see gate_size) and the box templates copied for each gate's box (see styledBox).
+        dataToDisplay = ax.transData.frozen()
+        transforms = (dataToDisplay, dataToDisplay.inverted(), {}, {})
+
         # Begin the circuit element rendering order at 3. This will be increased when necessary to ensure proper display ordering of the circuit elements.
         zorder = 3
 
+        # Adding each gate box as its own patch makes matplotlib update the axis for every artist, so the rendering time grows faster than the number of gates. Instead, collect the gate boxes and labels while looping over the circuit, and add them to the axis all at once afterwards. gatePatches stores the boxes of each zorder; gateLabels stores the position, label, and text size of each gate label, along with its zorder; connectors stores the keyword arguments of each connection annotation.
+        gatePatches = {}
+        gateLabels = []
+        connectors = []
+
         ## Display all the gate operations in the circuit.
 
-        # algorithmOn is a boolean that tracks whether the current circuit position is part of an algorithm. algTracker is the qubit that is the tracker for the current algorithm when algorithmOn is True. posOffset keeps track of how many positions algorithms take up so that gates after algorithms can be shifted to earlier positions in the diagram.
-        algorithmOn = False
-        algTracker = None
+        # algorithmEnd is the end position of the last algorithm displayed; the positions up to it are part of the algorithm and are not displayed. posOffset keeps track of how many positions algorithms take up so that gates after algorithms can be shifted to earlier positions in the diagram.
+        algorithmEnd = 0
         posOffset = 0
 
-        # Loop over the circuit position until maxGatePos (highest position of a gate among all qubits) is exceeded.
-        position = 1
-        maxGatePos = max([qubit.gatePos[-1] for qubit in self.qubits])
-        while position <= maxGatePos:
-
-            # If algorithmOn is True, the current position is part of an algorithm.
-            if algorithmOn:
-                # If the current position is the algorithm end, set algorithmOn to False.
-                if position in self.qubits[algTracker].algEnd:
-                    algorithmOn = False
-                # Increment the posOffset since the current position will not be displayed in the diagram.
-                posOffset += 1
-            
-            # If algorithmOn is False, loop over all the qubits and display their gate, connection, or algorithm being tracked at the current circuit position.
-            else:
-                for Qidx, qubit in reversed(list(enumerate(self.qubits))):
-
-                    # Coordinates to place the qubit's gate at; x = current position minus the current posOffset; y = negative of the current qubit index.
-                    xy = (position-posOffset, -1*Qidx)
-
-                    # If the current position is an algorithm, display the algorithm box over all qubits involved.
-                    if position in qubit.algStart:
-
-                        # Set algorithmOn to True and the algTracker to the current qubit. Get the index of this algorithm among all the current qubit's algorithms tracked (Aidx). Get the algorithm type (alg) and number of qubits involved (algNumQubits).
-                        algorithmOn = True
-                        algTracker = Qidx
-                        Aidx = qubit.algStart.index(position)
-                        alg = qubit.algorithms[Aidx]
-                        algNumQubits = qubit.algNumQubits[Aidx]
-
-                        # Format the algorithm box using format_algorithm. Add gateBox as a patch.
-                        [gateLabel, textSize, arrowprops, gateBox] = self.format_algorithm(alg, algNumQubits, xy, ax, zorder)
-                        ax.add_patch(gateBox)
-
-                        # Add the gate label as an annotation over the box. To center the label vertically, find the mean of the first and last qubit involved in the algorithm and negate the result.
-                        y = -1*np.mean([list(qubit.algQubits[Aidx])[0], list(qubit.algQubits[Aidx])[-1]])
-                        ax.annotate(gateLabel, xy=(xy[0],y), size=textSize, va='center', ha='center', zorder=zorder)
-
-                        # No algorithm gates should be displayed. Break out of the qubit for loop since algorithmOn is now True. The for loop will not be reentered until the entire algorithm gate sequence has been skipped over (in the display only).
-                        break
-
-                    # If the current position is in the qubit's connectPos, display the connection.
-                    if position in qubit.connectPos:
-
-                        # Reduce the zorder to render the connection below the target gate.
-                        zorder -= 1
-
-                        # Get the index of this connection among all the current qubit's connections (Cidx). Get the connection type (connection) and the target qubit to connect to (connectTo).
-                        Cidx = qubit.connectPos.index(position)
-                        connection = qubit.connections[Cidx]
-                        connectTo = qubit.connectTo[Cidx]
-
-                        # Format the connection symbol using format_gate. Add connectSym as a patch.
-                        [connectLabel, textSize, arrowprops, connectSym] = self.format_gate(connection, xy, ax, zorder)
-                        ax.add_patch(connectSym)
-
-                        # Add the connection label and connector as an annotation. xy = position of the target; xytext = position of the connection symbol.
-                        ax.annotate(connectLabel, xy=(position, -1*connectTo), xytext=xy, size=textSize, va='center', ha='center', arrowprops=arrowprops, zorder=zorder)
+        # Index the positions of each qubit's algorithms, connections, and gates, and of each classical bit's connections, with positionIndex. Checking a position against these dictionaries takes the same time however many gates the circuit has, whereas searching the lists grows with the length of the circuit. The algorithm ends are only used to find the end after an algorithm's start, so they are stored sorted.
+        qubitAlgStarts = [positionIndex(qubit.algStart) for qubit in self.qubits]
+        qubitAlgEnds = [sorted(qubit.algEnd) for qubit in self.qubits]
+        qubitConnections = [positionIndex(qubit.connectPos) for qubit in self.qubits]
+        qubitGates = [positionIndex(qubit.gatePos) for qubit in self.qubits]
+        cbitConnections = [positionIndex(cbit.connectPos) for cbit in self.cbits]
+
+        # At each position, only the qubits and classical bits with a gate, connection, or algorithm there have anything to display. positionQubits (positionCbits) stores the indices of those qubits (bits) at each position. The qubits and bits are displayed from the highest index down, so add the indices in that order.
+        positionQubits = {}
+        for Qidx in reversed(range(self.numQubits)):
+            qubit = self.qubits[Qidx]
+            for position in set(qubit.gatePos).union(qubit.connectPos, qubit.algStart):
+                positionQubits.setdefault(position, []).append(Qidx)
+        positionCbits = {}
+        for Bidx in reversed(range(self.numCbits)):
+            for position in set(self.cbits[Bidx].connectPos):
+                positionCbits.setdefault(position, []).append(Bidx)
+
+        # Loop over the circuit positions up to maxGatePos (highest position of a gate among all qubits, i.e. the circuit length). Positions without any gate, connection, or algorithm have nothing to display, so only loop over the positions that have at least one, in order.
+        maxGatePos = circuitLength
+        for position in sorted(positionQubits.keys() | positionCbits.keys()):
+            if position > maxGatePos:
+                break
+
+            # Skip the positions that are part of the last algorithm displayed.
+            if position <= algorithmEnd:
+                continue
+
+            # Loop over the qubits with a gate, connection, or algorithm being tracked at the current circuit position and display it.
+            for Qidx in positionQubits.get(position, ()):
+                qubit = self.qubits[Qidx]
+
+                # Coordinates to place the qubit's gate at; x = current position minus the current posOffset; y = negative of the current qubit index.
+                xy = (position-posOffset, -1*Qidx)
+
+                # If the current position is an algorithm, display the algorithm box over all qubits involved.
+                Aidx = qubitAlgStarts[Qidx].get(position)
+                if Aidx is not None:
+
+                    # Aidx is the index of this algorithm among all the current qubit's algorithms tracked. Get the algorithm type (alg) and number of qubits involved (algNumQubits).
+                    alg = qubit.algorithms[Aidx]
+                    algNumQubits = qubit.algNumQubits[Aidx]
+
+                    # Format the algorithm box using format_algorithm. Store gateBox with the patches of its zorder.
+                    [gateLabel, textSize, arrowprops, gateBox] = self.format_algorithm(alg, algNumQubits, xy, ax, zorder, transforms=transforms)
+                    gatePatches.setdefault(zorder, []).append(gateBox)
+
+                    # Store the gate label to be placed over the box. To center the label vertically, find the mean of the first and last qubit involved in the algorithm and negate the result.
+                    y = -1*np.mean([list(qubit.algQubits[Aidx])[0], list(qubit.algQubits[Aidx])[-1]])
+                    gateLabels.append((xy[0], y, gateLabel, textSize, zorder))
+
+                    # No algorithm gates should be displayed. The algorithm ends at the first of the current qubit's algorithm ends after the start (or at maxGatePos if the circuit ends first). Increase posOffset by the number of positions skipped, since they will not be displayed in the diagram, and break out of the qubit for loop. The positions up to algorithmEnd are skipped over (in the display only).
+                    algorithmEnd = min(next((end for end in qubitAlgEnds[Qidx] if end > position), maxGatePos), maxGatePos)
+                    posOffset += algorithmEnd - position
+                    break
+
+                # If the current position is in the qubit's connectPos, display the connection.
+                Cidx = qubitConnections[Qidx].get(position)
+                if Cidx is not None:
+
+                    # Reduce the zorder to render the connection below the target gate.
+                    zorder -= 1
+
+                    # Cidx is the index of this connection among all the current qubit's connections. Get the connection type (connection) and the target qubit to connect to (connectTo).
+                    connection = qubit.connections[Cidx]
+                    connectTo = qubit.connectTo[Cidx]
+
+                    # Format the connection symbol using format_gate. Store connectSym with the patches of its zorder.
+                    [connectLabel, textSize, arrowprops, connectSym] = self.format_gate(connection, xy, ax, zorder, transforms=transforms)
+                    gatePatches.setdefault(zorder, []).append(connectSym)
+
+                    # Store the connection label and connector to be added as an annotation. xy = position of the target; xytext = position of the connection symbol.
+                    connectors.append(dict(text=connectLabel, xy=(position, -1*connectTo), xytext=xy, size=textSize, va='center', ha='center', arrowprops=arrowprops, zorder=zorder))
+
+                    # Increase the zorder back to the gate layer.
+                    zorder += 1
+                
+                # If the current position is within the qubit's gatePos, display the gate.
+                Gidx = qubitGates[Qidx].get(position)
+                if Gidx is not None:
 
-                        # Increase the zorder back to the gate layer.
-                        zorder += 1
-                    
-                    # If the current position is within the qubit's gatePos, display the gate.
-                    if position in qubit.gatePos:
+                    # Gidx is the index of this gate among all the current qubit's gates. Get the gate type (gate) and angles for phase or rotation gates (angles).
+                    gate = qubit.gates[Gidx]
+                    angles = qubit.gateAngles[Gidx]
 
-                        # Get the index of this gate among all the current qubit's gates (Gidx). Get the gate type (gate) and angles for phase or rotation gates (angles).
-                        Gidx = qubit.gatePos.index(position)
-                        gate = qubit.gates[Gidx]
-                        angles = qubit.gateAngles[Gidx]
+                    # Format the gate box using format_gate. Store gateBox with the patches of its zorder. The angles are only used for phase and rotation gates; every other gate has NO_ANGLES, which format_gate ignores, so the angles can be provided without checking the gate type.
+                    [gateLabel, textSize, arrowprops, gateBox] = self.format_gate(gate, xy, ax, zorder, angles, transforms)
+                    gatePatches.setdefault(zorder, []).append(gateBox)
 
-                        # Format the gate box using format_gate. Add gateBox as a patch. If the gate is a phase or rotation gate, provide the angles to the function as well.
-                        if gate in {'P', 'RX', 'RY', 'RZ', 'U'}:
-                            angles = qubit.gateAngles[Gidx]
-                            [gateLabel, textSize, arrowprops, gateBox] = self.format_gate(gate, xy, ax, zorder, angles)
-                        else:
-                            [gateLabel, textSize, arrowprops, gateBox] = self.format_gate(gate, xy, ax, zorder)
-                        ax.add_patch(gateBox)
+                    # Store the gate label to be placed over the box.
+                    gateLabels.append((xy[0], xy[1], gateLabel, textSize, zorder))
 
-                        # Add the gate label as an annotation.
-                        ax.annotate(gateLabel, xy=xy, size=textSize, va='center', ha='center', zorder=zorder)
+            # Display each classical bit connection using the properties from format_gate
+            for Bidx in positionCbits.get(position, ()):
+                cbit = self.cbits[Bidx]
 
-                # Display each classical bit connection using the properties from format_gate
-                for Bidx, cbit in reversed(list(enumerate(self.cbits))):
+                # Coordinates to place the bit's operation at; x = current position minus the current posOffset; y = negative of the current bit index + total number of qubits in the circuit.
+                xy = (position-posOffset, -1*(Bidx+self.numQubits))
 
-                    # Coordinates to place the bit's operation at; x = current position minus the current posOffset; y = negative of the current bit index + total number of qubits in the circuit.
-                    xy = (position-posOffset, -1*(Bidx+self.numQubits))
+                # If the current position is in the bit's connectPos, display the connection.
+                Cidx = cbitConnections[Bidx].get(position)
+                if Cidx is not None:
 
-                    # If the current position is in the bit's connectPos, display the connection.
-                    if position in cbit.connectPos:
+                    # Reduce the zorder to render the connection below the target gate.
+                    zorder -= 1
 
-                        # Reduce the zorder to render the connection below the target gate.
-                        zorder -= 1
+                    # Cidx is the index of this connection among all the current bit's connections. Get the connection type (connection) and the target qubit to connect to (connectTo).
+                    connection = cbit.connections[Cidx]
+                    connectTo = cbit.connectTo[Cidx]
 
-                        # Get the index of this connection among all the current bit's connections (Cidx). Get the connection type (connection) and the target qubit to connect to (connectTo).
-                        Cidx = cbit.connectPos.index(position)
-                        connection = cbit.connections[Cidx]
-                        connectTo = cbit.connectTo[Cidx]
+                    # Format the connection symbol using format_gate. Store connectSym with the patches of its zorder.
+                    [connectLabel, textSize, arrowprops, connectSym] = self.format_gate(connection, xy, ax, zorder, transforms=transforms)
+                    gatePatches.setdefault(zorder, []).append(connectSym)
 
-                        # Format the connection symbol using format_gate. Add connectSym as a patch.
-                        [connectLabel, textSize, arrowprops, connectSym] = self.format_gate(connection, xy, ax, zorder)
-                        ax.add_patch(connectSym)
+                    # Store the connection label and connector to be added as an annotation. xy = position of the qubit being connected to; xytext = position of the connection symbol.
+                    connectors.append(dict(text=connectLabel, xy=(xy[0], -1*connectTo), xytext=xy, size=textSize, va='center', ha='center', arrowprops=arrowprops, zorder=zorder))
 
-                        # Add the connection label and connector as an annotation. xy = position of the qubit being connected to; xytext = position of the connection symbol.
-                        ax.annotate(connectLabel, xy=(xy[0], -1*connectTo), xytext=xy, size=textSize, va='center', ha='center', arrowprops=arrowprops, zorder=zorder)
+                    # Increase the zorder back to the gate layer.
+                    zorder += 1
 
-                        # Increase the zorder back to the gate layer.
-                        zorder += 1
+        # Add the gate boxes and connection symbols as one patch collection per zorder, keeping each patch's own colors and line widths. The axis limits are already set, so the collections do not need to update them.
+        for patchZorder, patches in gatePatches.items():
+            ax.add_collection(PatchCollection(patches, match_original=True, zorder=patchZorder), autolim=False)
 
-            # Increment the position for the next loop iteration.
-            position += 1
+        # Add the gate labels as plain text, which is cheaper than an annotation without a connector. Add the connection labels and connectors as annotations.
+        for [x, y, gateLabel, textSize, labelZorder] in gateLabels:
+            ax.text(x, y, gateLabel, size=textSize, va='center', ha='center', zorder=labelZorder)
+        for connector in connectors:
+            ax.annotate(**connector)
 
         # Display each classical bit. These are displayed first for proper layer ordering when displaying connections between qubits and classical bits.
         offset = 0.05
@@ -1107,239 +1151,411 @@ class Circuit:
 
         return
     
+    # Collect the gates applied to the circuit into a grid, with two rows for each circuit position (see below) and a column for each qubit. Returns the circuit length, the grid of gate types (with connections, e.g. 'C' for controls), and the grid of gate matrices.
+    def gate_grid(self):
+
+        # Convert the gate log into arrays. Subtract 1 from the positions since plotted gate positions start at 1 but Python indexing starts at 0. A gate spanning multiple qubits (or a measurement, whose connection spans down to its classical bit) can share its plotted position with single qubit gates on qubits outside of its span, which act on different qubits and are applied first. Give each plotted position two rows in the grid: the single qubit gates go in the first row, and the spanning gate in the second. The second row can only hold one spanning gate because of how positions are reserved: reserve_span moves the earliest position of every qubit past a controlled gate or SWAP, measure places each measurement after the previous one, and spanEarliestPos keeps later controlled gates and SWAPs after the last measurement. The circuit length is the number of rows up to the last gate in the circuit.
+        qubitIdx = np.asarray(self.allGateQubit, dtype=np.int64)
+        spanning = np.asarray(self.allGateSpanning, dtype=bool)
+        positions = 2*(np.asarray(self.allGatePos, dtype=np.int64) - 1) + spanning
+        circuitLength = int(positions.max()) + 1 if len(positions) > 0 else 0
+
+        # Check that every second row holds at most one spanning gate: a measurement or the target of a controlled gate counts as one gate each, a SWAP's two qubits count as half a gate each, and controls are part of their target's gate.
+        spanningTypes = np.asarray(self.allGateType, dtype=object)[spanning]
+        gateWeights = np.where(spanningTypes == 'C', 0, np.where(spanningTypes == 'SWAP', 1, 2))
+        assert np.all(np.bincount(positions[spanning], weights=gateWeights) <= 2), 'A circuit position holds more than one controlled gate, SWAP, or measurement.'
+
+        # For the gates, create a grid of I's with circuitLength rows and numQubits columns. Place every gate and connection in the log in the corresponding qubit's column and the row of the circuit position where it is applied, all at once. Do the same for the matrix of each gate, which was built when the gate was added to the circuit, placing identities everywhere else.
+        qubit_gates = np.full((circuitLength, self.numQubits), 'I', dtype='<U4')
+        qubit_gates[positions, qubitIdx] = self.allGateType
+        gate_matrices = np.broadcast_to(gateMatrix('I').astype(complex), (circuitLength, self.numQubits, 2, 2)).copy()
+        hasMatrix = np.array([matrix is not None for matrix in self.allGateMatrix], dtype=bool)
+        if hasMatrix.any():
+            gate_matrices[positions[hasMatrix], qubitIdx[hasMatrix]] = [matrix for matrix in self.allGateMatrix if matrix is not None]
+
+        # Convert the grid of gate types into lists of gate types for each position.
+        qubit_gates = qubit_gates.tolist()
+
+        return circuitLength, qubit_gates, gate_matrices
+
+    # Fuse the single qubit gates on each qubit into as few circuit positions as possible. Applying gate A and then gate B to a qubit is the same as applying the single matrix B*A, so the 2x2 matrices on each qubit are multiplied together ahead of time, and the circuit's state is only updated once instead of once per gate. A single qubit gate is moved back into the earliest position of single qubit gates that no controlled gate, SWAP, or measurement on the same qubit has come after, since the gates in between act on other qubits and do not change the result. Fused gates are labeled 'FUSED'. Barriers do not change the circuit's state, so they are removed and do not stop gates from being moved past them. Returns the new grids of gate types and gate matrices.
+    def fuse_single_qubit_gates(self, qubit_gates, gate_matrices):
+
+        fusedGates = []
+        fusedMatrices = []
+
+        # openPos stores, for each qubit, the index of the fused position of single qubit gates that the qubit's next single qubit gate can be moved into, or None if a controlled gate, SWAP, or measurement on the qubit has come since the last such position.
+        openPos = [None for Qidx in range(self.numQubits)]
+        for gates, matrices in zip(qubit_gates, gate_matrices):
+
+            # Skip over barriers.
+            if 'B' in gates:
+                continue
+
+            # Positions with a controlled gate, SWAP, or measurement are kept as they are. Gates on the qubits they involve can no longer be moved before them.
+            if set(gates) & {'C', 'SWAP', 'M'}:
+                fusedGates.append(list(gates))
+                fusedMatrices.append(list(matrices))
+                for Qidx, gate in enumerate(gates):
+                    if gate != 'I':
+                        openPos[Qidx] = None
+                continue
+
+            # For positions of single qubit gates, multiply each gate's matrix onto the matrix of the qubit's open position. Gates on qubits without an open position are placed in a new position, which is then the open position of every qubit without one.
+            remainingGates = ['I' for Qidx in range(self.numQubits)]
+            remainingMatrices = list(matrices)
+            for Qidx, gate in enumerate(gates):
+                if gate == 'I':
+                    continue
+                if openPos[Qidx] is None:
+                    remainingGates[Qidx] = gate
+                else:
+                    fusedGates[openPos[Qidx]][Qidx] = 'FUSED'
+                    fusedMatrices[openPos[Qidx]][Qidx] = matrices[Qidx] @ fusedMatrices[openPos[Qidx]][Qidx]
+                    remainingMatrices[Qidx] = gateMatrix('I')
+            if set(remainingGates) != {'I'}:
+                fusedGates.append(remainingGates)
+                fusedMatrices.append(remainingMatrices)
+                for Qidx in range(self.numQubits):
+                    if openPos[Qidx] is None:
+                        openPos[Qidx] = len(fusedGates) - 1
+
+        return fusedGates, fusedMatrices
+
+    # Get the unitary matrix of the whole circuit, i.e. the 2^numQubits x 2^numQubits matrix that the circuit applies to any initial state. Rows and columns are indexed the same as the circuit's state (qubit 0 is the least significant bit). Measurements are not unitary, so they may only come at the end of the circuit, where they are ignored.
+    #
+    # Rather than multiplying the full Kronecker matrix of every circuit position together, the circuit is treated as a tensor network: each gate is a small tensor with an input and output index (leg) for each qubit it acts on, and each gate's input legs are connected to the output legs of the previous gates on those qubits. The network is contracted with numpy's einsum, which picks the order of the contractions (optimize = 'greedy' or 'optimal', see numpy.einsum_path). The order is found once for each structure of network and reused (see contractNetwork). Contracting gates in a good order avoids building the 2^numQubits x 2^numQubits matrix of each position. einsum can label at most 52 legs at once, so once the legs run out, the gates so far are contracted into a single tensor and the remaining gates connect to it.
+    def unitary(self, optimize='greedy'):
+
+        # Every contraction keeps the input and output legs of each qubit (2 per qubit), plus the output legs of the next gate (up to one per qubit).
+        maxLegs = 52
+        numQubits = self.numQubits
+        if 3*numQubits > maxLegs:
+            raise ValueError('unitary() supports circuits of up to %i qubits.' % (maxLegs//3))
+
+        # Get the circuit length and the gates and matrices at each circuit position.
+        circuitLength, qubit_gates, gate_matrices = self.gate_grid()
+
+        # Start the network with an identity tensor on each qubit. inputLegs = input leg of each qubit; currentLegs = latest output leg of each qubit, which the next gate on the qubit connects to; operands = alternating list of tensors and their legs, as accepted by einsum; nextLeg = next unused leg label.
+        inputLegs = list(range(numQubits))
+        currentLegs = list(range(numQubits, 2*numQubits))
+        operands = []
+        for Qidx in range(numQubits):
+            operands += [gateMatrix('I'), [currentLegs[Qidx], inputLegs[Qidx]]]
+        nextLeg = 2*numQubits
+
+        # Output legs of the contracted network. The axes are ordered from the highest index qubit to the lowest, so that reshaping the result into a matrix puts qubit 0 in the least significant bit.
+        def outputLegs():
+            return currentLegs[::-1] + inputLegs[::-1]
+
+        measured = False
+        for pos in range(circuitLength):
+
+            # Get the current position's list of gates. Skip over barriers and empty positions since they do not change the circuit's state.
+            gates = qubit_gates[pos]
+            if gates[-1] == 'B' or set(gates) == {'I'}:
+                continue
+
+            # Measurements are ignored when they end the circuit. Any other gate after a measurement, or at the same position as one, means the circuit has no unitary matrix.
+            if 'M' in gates:
+                measured = True
+                if set(gates) <= {'M', 'I', 'B'}:
+                    continue
+            if measured:
+                raise ValueError('The circuit has gates after a measurement, so it has no unitary matrix.')
+
+            # A SWAP gate only exchanges which qubit each leg belongs to, so swap the current output legs of the two qubits instead of adding a tensor.
+            if 'SWAP' in gates:
+                [Qidx1, Qidx2] = [Qidx for Qidx, gate in enumerate(gates) if gate == 'SWAP']
+                currentLegs[Qidx1], currentLegs[Qidx2] = currentLegs[Qidx2], currentLegs[Qidx1]
+                continue
+
+            # Build the tensors for the gates at this position. A controlled gate is one tensor over its control and target qubits: the identity, except on the states where every control qubit is |1>, where the target's gate is applied. Every single qubit gate is its own 2x2 tensor.
+            if 'C' in gates:
+                qubitsInvolved = [Qidx for Qidx, gate in enumerate(gates) if gate != 'I']
+                [target] = [Qidx for Qidx in qubitsInvolved if gates[Qidx] != 'C']
+                numInvolved = len(qubitsInvolved)
+                targetBit = 1 << qubitsInvolved.index(target)
+                allControls = (1 << numInvolved) - 1 - targetBit
+                blockStates = [allControls, allControls | targetBit]
+                matrix = np.eye(1 << numInvolved, dtype=complex)
+                matrix[np.ix_(blockStates, blockStates)] = gate_matrices[pos][target]
+                tensors = [(matrix.reshape((2,)*(2*numInvolved)), qubitsInvolved)]
+            else:
+                tensors = [(gate_matrices[pos][Qidx], [Qidx]) for Qidx, gate in enumerate(gates) if gate != 'I']
+
+            for tensor, qubitsInvolved in tensors:
+
+                # If there are not enough unused legs left for this gate, contract the network so far into one tensor and relabel its legs.
+                if nextLeg + len(qubitsInvolved) > maxLegs:
+                    contracted = contractNetwork(operands, outputLegs(), optimize)
+                    inputLegs = list(range(numQubits))
+                    currentLegs = list(range(numQubits, 2*numQubits))
+                    operands = [contracted, outputLegs()]
+                    nextLeg = 2*numQubits
+
+                # Give the gate a new output leg for each qubit it acts on, and connect its input legs to the qubits' current output legs.
+                newLegs = list(range(nextLeg, nextLeg + len(qubitsInvolved)))
+                nextLeg += len(qubitsInvolved)
+                tensorInputs = [currentLegs[Qidx] for Qidx in qubitsInvolved]
+                for Qidx, leg in zip(qubitsInvolved, newLegs):
+                    currentLegs[Qidx] = leg
+                operands += [tensor, newLegs[::-1] + tensorInputs[::-1]]
+
+        # Contract the remaining network and reshape the result into a 2^numQubits x 2^numQubits matrix.
+        dim = 1 << numQubits
+        return contractNetwork(operands, outputLegs(), optimize).reshape(dim, dim)
+
     # Run the circuit to calculate the final state of the qubits.
     def run(self, shots, hist=False):
 
-        # Get the circuit length. For each qubit, get the last gate position applied to the qubit. Update circuitLength to be the highest gate position in the circuit.
-        circuitLength = 0
-        for qubit in self.qubits:
-            if len(qubit.gates) > 0:
-                lastPos = qubit.gatePos[-1]
-                if lastPos > circuitLength:
-                    circuitLength = lastPos
-
-        # For the gates, create a matrix of I's with circuitLength rows and numQubits columns. Update the matrix with the gates and connections applied to each qubit, placing the gate in the corresponding qubit's column and the row of the circuit position where the gate/connection is applied. Do the same for the angles of each gate.
-        qubit_gates = [['I' for qubit in self.qubits] for pos in range(circuitLength)]
-        gate_angles = [[[] for qubit in self.qubits] for pos in range(circuitLength)]
-        for Qidx, qubit in enumerate(self.qubits):
-            for Gidx, gate in enumerate(qubit.gates):
-                # Subtract 1 since plotted gate positions start at 1 but Python indexing starts at 0
-                gatePos = qubit.gatePos[Gidx] - 1
-                qubit_gates[gatePos][Qidx] = gate
-                gate_angles[gatePos][Qidx] = qubit.gateAngles[Gidx]
-            for Cidx, connection in enumerate(qubit.connections):
-                # Subtract 1 since plotted gate positions start at 1 but Python indexing starts at 0
-                connectPos = qubit.connectPos[Cidx] - 1
-                qubit_gates[connectPos][Qidx] = connection
+        # Get the gates and matrices at each circuit position, fusing consecutive positions of single qubit gates into one. Get the circuit length after fusing. Reuse the grid from the last run if no gates have been added since (e.g. when running the same circuit again with more shots).
+        if self.fusedGrid is None or self.fusedGrid[0] != len(self.allGatePos):
+            _, qubit_gates, gate_matrices = self.gate_grid()
+            qubit_gates, gate_matrices = self.fuse_single_qubit_gates(qubit_gates, gate_matrices)
+            self.fusedGrid = (len(self.allGatePos), qubit_gates, gate_matrices)
+        [_, qubit_gates, gate_matrices] = self.fusedGrid
+        circuitLength = len(qubit_gates)
 
         # Store for initial state of the circuit (usually |0> for each qubit) to reset the circuit state at the start of each shot.
         initialState = self.state
 
-        # Create an empty list of results with size equal to the total number of shots. Repeat the circuit's gate applications and measurements for each shot, storing the result from each shot in the list 'results'.
-        results = ['']*shots
-        for shot in range(shots):
-
-            # Reset the circuit state
-            self.state = initialState
-
-            # Loop over each circuit position, creating the Kronecker matrix using all the gates at the position and applying it to the current circuit state (self.state).
-            for pos in range(circuitLength):
-
-                # Get the current position's list of gates.
-                gates = qubit_gates[pos]
-
-                # Skip over barriers since they do not change the circuit's state. Go to the next circuit position.
-                if gates[-1] == 'B':
-                    continue
-
-                # Skip over algorithm indicators since they are only used for displaying the circuit. The actual gates within the algorithm start at the next circuit position. Go to the next position.
-                if set(['QFT','IQFT','QPE']) & set(gates[-1]):
-                    continue
-
-                # If there is a controlled gate within the current position:
-                if 'C' in gates:
-
-                    # Get the number of control qubits for the controlled gate.
-                    numControls = gates.count('C')
-
-                    # To calculate the matrix that represents a controlled gate, we have to calculate a Kronecker matrix for each possible combination of controlled qubit outcomes and then sum the matrices. These Kronecker matrices are calculated from the projection matrices into either the |0> or |1> state for each control qubit and the target's intended gate if all control qubits are projected into the |1> state (identity matrix otherwise).
-
-                    # If there are numControls control qubits that can each be measured in either the |0> or |1> state, then there are 2**numControls different outcomes for the controlled gate. Create a list that will contain the Kronecker matrix for each possible outcome.
-                    numOutcomes = 2**numControls
-                    outcomeKroneckers = [np.array([1]) for outcome in range(numOutcomes)]
-
-                    # Each Kronecker matrix within outcomeKroneckers is associated with a unique combination of control qubit measurement outcomes. Create a list of each combination of control qubit outcomes using the Cartesian product. E.g. if there are 2 control qubits, the list would contain: '00', '01', '10', '11'
-                    controlOutcomeCombos = CartesianProduct([0, 1], repeat=numControls)
-                    controlOutcomeCombos = [list(outcome) for outcome in controlOutcomeCombos]
-
-                    # Within each combo in the list controlOutcomeCombos, the first number represents the outcome for the first control qubit, the second number for the second control qubit, etc. To keep track of which index to use for each control qubit, the variable controlNum will track how many control qubits we have already encountered for the current controlled gate. The variable starts at 0 so that the first control qubit will use index 0, and the variable will be incremented every time a control qubit is encountered.
-                    controlNum = 0
-
-                    # Loop over each qubit to get its gate for the current circuit position.
-                    for Qidx, qubit in enumerate(self.qubits):
-
-                        # Get the gate type and the angles for it (for phase and rotation gates).
-                        gateType = gates[Qidx]
-                        angles = gate_angles[pos][Qidx]
-
-                        # If the qubit is a control:
-                        if gateType == 'C':
-
-                            # Loop over the different control qubit outcome combinations. The variable idx will track which matrix within outcomeKroneckers to apply the current qubit's projection matrix to.
-                            idx = 0
-                            for combo in controlOutcomeCombos:
-
-                                # Get the outcome within the current combo for the current control qubit. Use controlNum as the index (see explanation of controlNum above).
-                                outcome = combo[controlNum]
-
-                                # For an outcome of 0 for the current control qubit, use the projection into |0> for the Kronecker matrix.
-                                if outcome == 0:
-                                    outcomeKroneckers[idx] = np.kron(gateMatrix('P0'), outcomeKroneckers[idx])
-                                
-                                # For an outcome of 1 for the current control qubit, use the projection into |1> for the Kronecker matrix.
-                                else: # outcome == 1
-                                    outcomeKroneckers[idx] = np.kron(gateMatrix('P1'), outcomeKroneckers[idx])
-
-                                # Increment idx so that the projection matrix for the next combo in controlOutcomeCombo will be applied to the next matrix within outcomeKroneckers.
-                                idx += 1
-
-                            # The current control qubit is done, so increment controlNum so that the next control qubit encountered will use the next index within each combo in controlOutcomeCombo.
-                            controlNum += 1
-
-                        # If the gate type is not a control or an identity, this is the target qubit.
-                        elif gateType != 'I':
-
-                            # Loop over the possible outcome combinations of the control qubits.
-                            idx = 0
-                            for combo in controlOutcomeCombos:
-
-                                # If all control qubits measure |1> within the current combo, apply the intended target gate to the corresponding matrix within outcomeKroneckers.
-                                if all(combo):
-                                    outcomeKroneckers[idx] = np.kron(gateMatrix(gateType, angles), outcomeKroneckers[idx])
-                                
-                                # Otherwise, when at least one control qubit measures to 0, apply the identity matrix.
-                                else:
-                                    outcomeKroneckers[idx] = np.kron(gateMatrix('I'), outcomeKroneckers[idx])
-
-                                # Go to the next matrix within outcomeKroneckers.
-                                idx += 1
-
-                        # For all other qubits in the circuit that are not involved within the controlled gate, apply an identity matrix to each matrix within outcomeKroneckers.
-                        else:
-                            idx = 0
-                            for combo in controlOutcomeCombos:
-                                outcomeKroneckers[idx] = np.kron(gateMatrix('I'), outcomeKroneckers[idx])
-                                idx += 1
-
-                    # With the Kronecker matrix for each combination of control qubit outcomes calculated, sum the matrices to get the final matrix that represents the operation of the controlled gate.
-                    kronMatrix = np.sum(outcomeKroneckers, axis=0)
-                
-                # For SWAP gates:
-                elif 'SWAP' in gates:
-                    
-                    # SWAP gates can be decomposed into 1/2 the sum of Kronecker matrices that apply an identity to each qubit, an X gate to each qubit, a Y gate to each qubit, and a Z gate to each qubit.
-
-                    # Create 3 separate Kronecker matrices for the two target qubits to receive X, Y, and Z gates together. All other qubits will get an identity.
-                    kronXMatrix = np.array([1])
-                    kronYMatrix = np.array([1])
-                    kronZMatrix = np.array([1])
-
-                    for Qidx, qubit in enumerate(self.qubits):
-                        
-                        # For each qubit, get the gate type.
-                        gateType = gates[Qidx]
-
-                        # For SWAP gates, apply an X, Y, and Z gate to the corresponding Kronecker matrix.
-                        if gateType == 'SWAP':
-                            kronXMatrix = np.kron(gateMatrix('X'), kronXMatrix)
-                            kronYMatrix = np.kron(gateMatrix('Y'), kronYMatrix)
-                            kronZMatrix = np.kron(gateMatrix('Z'), kronZMatrix)
-                        
-                        # Otherwise, the gate type will be an identity. Apply the identity to all 3 Kronecker matrices.
-                        else:
-                            kronXMatrix = np.kron(gateMatrix('I'), kronXMatrix)
-                            kronYMatrix = np.kron(gateMatrix('I'), kronYMatrix)
-                            kronZMatrix = np.kron(gateMatrix('I'), kronZMatrix)
-                    
-                    # Add the 3 Kronecker matrices to an identity matrix of the same size and take 1/2 the sum. This is the final matrix that represents the SWAP gate operation.
-                    kronMatrix = 0.5*(np.eye(np.size(kronXMatrix, 0)) + kronXMatrix + kronYMatrix + kronZMatrix)
-                
-                # For measurements (in computational basis):
-                elif 'M' in gates:
-
-                    # Create 2 Kronecker product matrices for the projection of the target qubit into the |0> or |1> state. All other qubits will get an identity.
-                    kron0Matrix = np.array([1])
-                    kron1Matrix = np.array([1])
-
-                    measuredQubit = 0
-                    for Qidx, qubit in enumerate(self.qubits):
-
-                        # For each qubit, get the gate type.
-                        gateType = gates[Qidx]
-
-                        # For measurements, apply the projection matrix into |0> and |1> to the corresponding Kronecker matrix.
-                        if gateType == 'M':
-                            kron0Matrix = np.kron(gateMatrix('P0'), kron0Matrix)
-                            kron1Matrix = np.kron(gateMatrix('P1'), kron1Matrix)
-
-                            # Store the index of the qubit being measured in measuredQubit.
-                            measuredQubit = Qidx
-                        
-                        # Otherwise, the gate type is an identity. Apply an identity to each Kronecker matrix.
-                        else:
-                            kron0Matrix = np.kron(gateMatrix('I'), kron0Matrix)
-                            kron1Matrix = np.kron(gateMatrix('I'), kron1Matrix)
-                    
-                    # For each of the |0> and |1> state projection matrices, apply the projection to the circuit's current state to get the resulting state. Transpose the circuit's current state (without the projection) and apply it to the resulting state (with the projection) to get the probability of the measurement outcome.
-                    state0 = np.dot(kron0Matrix, self.state)
-                    prob0 = np.vdot(state0, state0)
-                    state1 = np.dot(kron1Matrix, self.state)
-                    prob1 = np.vdot(state1, state1)
-                    
-                    # Generate a random number between 0 and 1. If it is less than the probability of the target qubit being in the 0 state, set the classical bit to 0 and update the circuit's state with the projection-into-0 state from above (normalized with the square root of the probability of measuring 0). Otherwise, set the classical bit to 1 and update the circuit's state with the projection-into-1 state (normalized).
-                    if np.random.rand(1) < prob0:
-                        self.cbits[measuredQubit].state = 0
-                        self.state = state0 / np.sqrt(prob0)
-                    else:
-                        self.cbits[measuredQubit].state = 1
-                        self.state = state1 / np.sqrt(prob1)
-
-                # For single qubit gates:
+        # Find the first circuit position containing a measurement. If every position after it holds nothing but measurements, identities, and barriers, all measurements happen at the end of the circuit. The state before the measurements is then the same for every shot, so the circuit only needs to be simulated once, and the measurement outcomes of all shots can be sampled together from the probabilities of the final state. A position with a measurement and any other gate is not skipped this way; the shots are simulated instead.
+        measurePositions = [pos for pos in range(circuitLength) if 'M' in qubit_gates[pos]]
+        firstMeasurePos = measurePositions[0] if measurePositions else circuitLength
+        terminalMeasurements = all(set(gates) <= {'M', 'I', 'B'} for gates in qubit_gates[firstMeasurePos:])
+        if terminalMeasurements:
+            simulatedShots = 1
+            simulatedLength = firstMeasurePos
+        else:
+            simulatedShots = shots
+            simulatedLength = circuitLength
+
+        # Create an array to store the state of each classical bit (0 or 1) for each shot. Classical bits that are never measured stay in the 0 state.
+        cbitStates = np.zeros((shots, self.numCbits), dtype=np.uint8)
+
+        # The gates are applied to the circuit's state as a tensor with one axis of length 2 per qubit, rather than as a vector of length 2^numQubits. Each gate then only acts along the axes of the qubits it involves, so the 2^numQubits x 2^numQubits Kronecker matrix of the gates never needs to be built. The states of many shots are simulated together, stacked along the first axis of the tensor, so that each gate is applied to all of them at once. Since qubit 0 is the least significant bit of the state's index, qubit Qidx is axis numQubits-Qidx of the tensor.
+        numQubits = self.numQubits
+        def qubitAxis(Qidx):
+            return numQubits - Qidx
+
+        # Functions applying each type of operation to the circuit's state of every shot in the current batch (see below). Each takes the state and the operation's precomputed arguments and returns the new state.
+
+        # For single qubit gates, apply each gate's matrix (or the matrix of each group of gates, see below) along its axis. Write the result into whichever of the two state buffers (see below) the state is not in.
+        def applySingleGates(state, singleGates):
+            for gateAxis, matrix in singleGates:
+                spare = stateBuffers[1] if np.may_share_memory(state, stateBuffers[0]) else stateBuffers[0]
+                state = applyGate(state, matrix, gateAxis, out=spare[:len(state)])
+            return state
+
+        # For single qubit gates with diagonal matrices (e.g. Z, S, T, P, and RZ), each gate only multiplies every amplitude by a phase, depending on the states of the qubits it acts on. Multiply the state in place by each tensor of phases, which broadcasts along the axes of the qubits without a gate, instead of multiplying it by the gates' matrices.
+        def applyDiagonalGates(state, phaseTensors):
+            for phases in phaseTensors:
+                state *= phases
+            return state
+
+        # For controlled gates, apply the target's gate along the target's axis within the part of the state where every control qubit is |1>. The rest of the state is unchanged.
+        def applyControlledGate(state, controlsOne, subAxis, matrix):
+            state[controlsOne] = applyGate(state[controlsOne], matrix, subAxis)
+            return state
+
+        # For controlled gates with a diagonal target gate (e.g. CZ and the controlled-P gates of the QFT), the gate only multiplies the amplitudes where every control qubit is |1> by a phase, depending on the state of the target. Multiply each part of the state by its phase in place instead of applying the gate's matrix.
+        def applyControlledPhase(state, phaseParts):
+            for part, phase in phaseParts:
+                state[part] *= phase
+            return state
+
+        # For SWAP gates, exchange the axes of the two qubits.
+        def applySwap(state, axis1, axis2):
+            return np.swapaxes(state, axis1, axis2)
+
+        # For measurements (in computational basis):
+        def measureQubit(state, slice0, slice1, measuredQubit):
+
+            # The probability of each outcome in each shot is the sum of the squared magnitudes of the amplitudes in its slice (summing over every axis except the shots axis).
+            qubitAxes = tuple(range(1, numQubits))
+            prob0 = np.sum(np.abs(state[slice0])**2, axis=qubitAxes)
+            prob1 = np.sum(np.abs(state[slice1])**2, axis=qubitAxes)
+
+            # If the outcome is certain in every shot (the probability of the other outcome is 0, up to rounding), store it without drawing random numbers. Set the slice of the other outcome to 0; the state is already normalized.
+            if np.all(prob1 < 1e-14):
+                cbitStates[batchStart:batchEnd, measuredQubit] = 0
+                state[slice1] = 0
+                return state
+            if np.all(prob0 < 1e-14):
+                cbitStates[batchStart:batchEnd, measuredQubit] = 1
+                state[slice0] = 0
+                return state
+
+            # Generate a random number between 0 and 1 for each shot. If it is less than the probability of the target qubit being in the 0 state, the shot's outcome is 0, otherwise it is 1. Store the outcomes in the classical bit. Set the slice of the other outcome to 0 and normalize the slice of the measured outcome with the square root of its probability.
+            outcomes = self.rng.random(numBatchShots) >= prob0
+            cbitStates[batchStart:batchEnd, measuredQubit] = outcomes
+            norm = 1/np.sqrt(np.where(outcomes, prob1, prob0))
+            shotsShape = (numBatchShots,) + (1,)*(numQubits - 1)
+            state[slice0] *= np.where(outcomes, 0, norm).reshape(shotsShape)
+            state[slice1] *= np.where(outcomes, norm, 0).reshape(shotsShape)
+            return state
+
+        # The gates at each circuit position are the same for every shot, so get the operation of each position once, before any shots are run. positionOps stores, for each circuit position that changes the circuit's state, the function that applies its operation and the axes (and matrices) it acts on. The type of each position is thus only checked once, rather than for every position of every batch of shots.
+        positionOps = []
+        identity = gateMatrix('I')
+        for pos in range(simulatedLength):
+
+            # Get the current position's list of gates.
+            gates = qubit_gates[pos]
+
+            # Skip over barriers since they do not change the circuit's state. Go to the next circuit position.
+            if gates[-1] == 'B':
+                continue
+
+            # Skip over algorithm indicators since they are only used for displaying the circuit. The actual gates within the algorithm start at the next circuit position. Go to the next position.
+            if set(['QFT','IQFT','QPE']) & set(gates[-1]):
+                continue
+
+            # For controlled gates, the target's gate is only applied to the part of the state where every control qubit is |1>. Store the index that selects that part of the state (1 along each control axis), the target's axis within it, and the target's gate matrix. The target's axis shifts down by one for every control axis before it.
+            if 'C' in gates:
+                controlAxes = [qubitAxis(Qidx) for Qidx, gate in enumerate(gates) if gate == 'C']
+                [target] = [Qidx for Qidx, gate in enumerate(gates) if gate not in ('C', 'I')]
+                targetAxis = qubitAxis(target)
+                controlsOne = [slice(None)]*(numQubits + 1)
+                for controlAxis in controlAxes:
+                    controlsOne[controlAxis] = 1
+                subAxis = targetAxis - sum(controlAxis < targetAxis for controlAxis in controlAxes)
+                matrix = gate_matrices[pos][target].astype(self.dtype)
+
+                # If the target's gate is diagonal, store the index of the part of the state where every control qubit is |1> and the target is |0> or |1>, along with the phase to multiply it by (the diagonal element of the gate's matrix). Parts with a phase of 1 are left out since they do not change.
+                if matrix[0, 1] == 0 and matrix[1, 0] == 0:
+                    phaseParts = []
+                    for targetState in (0, 1):
+                        if matrix[targetState, targetState] != 1:
+                            part = list(controlsOne)
+                            part[targetAxis] = targetState
+                            phaseParts.append((tuple(part), matrix[targetState, targetState]))
+                    if phaseParts:
+                        positionOps.append((applyControlledPhase, (phaseParts,)))
                 else:
-
-                    #  Create the Kronecker product matrix defining the gate operations.
-                    kronMatrix = np.array([1])
-
-                    for Qidx, qubit in enumerate(self.qubits):
-
-                        # Get the gate type.
-                        gateType = gates[Qidx]
-
-                        # For phase and rotation gates, get the angles needed to define the gate and apply the gate to the Kronecker matrix.
-                        if gateType in {'P', 'RX', 'RY', 'RZ', 'U'}:
-                            angles = gate_angles[pos][Qidx]
-                            kronMatrix = np.kron(gateMatrix(gateType, angles), kronMatrix)
-                        
-                        # Other gates don't need angles and can be applied to the Kronecker matrix.
-                        else:
-                            kronMatrix = np.kron(gateMatrix(gateType), kronMatrix)
-                
-                # The measurement operation above changes the circuit's state within the elif statement. If the current circuit position does not contain a measurement, apply the gates to the circuit's state, updating the state.
-                if 'M' not in gates:
-                    self.state = np.dot(kronMatrix, self.state)
-
-            # Create a string containing the classical bit states at the end of the circuit. Reverse the bit order so bit 0 is on the far right. Style the list as a ket since thise is the state of the qubits, despite being stored in the classical bits.
-            result = ''.join(reversed([str(cbit.state) for cbit in self.cbits]))
-            result = '|' + result + '>'
-
-            # Store the current result in the 'shot' index in the list of all results.
-            results[shot] = result
+                    positionOps.append((applyControlledGate, (tuple(controlsOne), subAxis, matrix)))
+
+            # For SWAP gates, store the axes of the two qubits to swap.
+            elif 'SWAP' in gates:
+                swapAxes = [qubitAxis(Qidx) for Qidx, gate in enumerate(gates) if gate == 'SWAP']
+                positionOps.append((applySwap, tuple(swapAxes)))
+
+            # For measurements (in computational basis), store the index of the measured qubit and the indices that select the parts of the state where the measured qubit is |0> and |1> (the slices at index 0 and 1 along the measured qubit's axis).
+            elif 'M' in gates:
+                measuredQubit = gates.index('M')
+                slice0 = [slice(None)]*(numQubits + 1)
+                slice0[qubitAxis(measuredQubit)] = 0
+                slice1 = [slice(None)]*(numQubits + 1)
+                slice1[qubitAxis(measuredQubit)] = 1
+                positionOps.append((measureQubit, (tuple(slice0), tuple(slice1), measuredQubit)))
+
+            # For single qubit gates, store the axis and matrix of each gate. Skip identities, including gates that were fused into an identity (e.g. two X gates in a row). Convert the matrices to the state's data type so that a single precision state is not promoted to double precision. If every gate is an identity, the position does not change the circuit's state.
+            else:
+                singleGates = [(qubitAxis(Qidx), gate_matrices[pos][Qidx].astype(self.dtype)) for Qidx, gate in enumerate(gates) if gate != 'I' and not np.allclose(gate_matrices[pos][Qidx], identity, rtol=0, atol=1e-14)]
+
+                # Each gate applied separately is a full pass over the state. Instead, combine the gates on up to maxBlockQubits consecutive axes into one matrix (the Kronecker product of the gates, with identities for axes in between without a gate), so the state is only passed over once for each group. The first axis of a group is the most significant, so its gate is the first factor of the product. A group with a single gate is applied as the 2x2 gate.
+                maxBlockQubits = 4
+                singleGates.sort(key=lambda singleGate: singleGate[0])
+                groupedGates = []
+                while singleGates:
+                    firstAxis = singleGates[0][0]
+                    group = [singleGate for singleGate in singleGates if singleGate[0] < firstAxis + maxBlockQubits]
+                    singleGates = singleGates[len(group):]
+                    if len(group) == 1:
+                        groupedGates.append(group[0])
+                        continue
+                    groupMatrices = dict(group)
+                    matrix = np.ones((1, 1), dtype=self.dtype)
+                    for gateAxis in range(firstAxis, group[-1][0] + 1):
+                        matrix = np.kron(matrix, groupMatrices.get(gateAxis, identity.astype(self.dtype)))
+                    groupedGates.append((firstAxis, matrix))
+
+                # A group whose matrix is diagonal only multiplies the state by phases, which is several times faster than multiplying it by the matrix. Store the group's phases (the diagonal of its matrix) as a tensor with an axis of length 2 for each of the group's axes and length 1 for every other axis, so that it broadcasts over the state. Broadcasting over only the last axes of the state is slow, since it multiplies rows of just a few amplitudes, so a group among the last axes is extended (with phases of 1) to at least the last 4 axes. The gates at a position act on different qubits, so the diagonal groups can be applied separately from the others.
+                phaseTensors = []
+                matrixGates = []
+                for firstAxis, matrix in groupedGates:
+                    phases = np.diagonal(matrix)
+                    if np.any(matrix != np.diag(phases)):
+                        matrixGates.append((firstAxis, matrix))
+                        continue
+                    lastAxis = firstAxis + phases.size.bit_length() - 2
+                    if lastAxis > numQubits - 4:
+                        extendedFirstAxis = min(firstAxis, max(1, numQubits - 3))
+                        phases = np.kron(np.ones(1 << (firstAxis - extendedFirstAxis)), np.kron(phases, np.ones(1 << (numQubits - lastAxis))))
+                        firstAxis, lastAxis = extendedFirstAxis, numQubits
+                    phaseTensors.append(phases.astype(self.dtype).reshape((1,)*firstAxis + (2,)*(lastAxis - firstAxis + 1) + (1,)*(numQubits - lastAxis)))
+                if phaseTensors:
+                    positionOps.append((applyDiagonalGates, (phaseTensors,)))
+                if matrixGates:
+                    positionOps.append((applySingleGates, (matrixGates,)))
+
+        # Simulate the shots in batches, storing the classical bit states from each shot in cbitStates. Limit each batch to about 2^22 amplitudes (64 MB for double precision) so that the stacked states fit in memory.
+        batchSize = max(1, min(simulatedShots, (1 << 22) >> numQubits))
+
+        # Allocate the memory for the states of a batch once, rather than for every batch and every gate. The state of the batch is kept in one of two buffers. Single qubit gates write their result into the other buffer, and all other operations update the state in place (or, for SWAPs, only change how the buffer is viewed).
+        stateBuffers = [np.empty((batchSize,) + (2,)*numQubits, dtype=initialState.dtype) for buffer in range(2)]
+
+        for batchStart in range(0, simulatedShots, batchSize):
+            batchEnd = min(batchStart + batchSize, simulatedShots)
+            numBatchShots = batchEnd - batchStart
+
+            # Reset the circuit state of each shot in the batch, copying the initial state into the first buffer.
+            state = stateBuffers[0][:numBatchShots]
+            np.copyto(state, initialState.reshape((1,) + (2,)*numQubits))
+
+            # Loop over each circuit position that changes the circuit's state, applying the position's operation to the current circuit state of every shot.
+            for operation, args in positionOps:
+                state = operation(state, *args)
+
+            # Store the final state of the last shot as a column vector. Copy it out of the buffer, which is reused by the next batch.
+            self.state = state[-1].reshape(-1, 1).copy()
+
+        # If all measurements are at the end of the circuit, sample the outcome of every shot at once. The probability of each basis state is the squared magnitude of its amplitude, computed in double precision so that the cumulative probabilities stay accurate for single precision states. Draw a random number between 0 and 1 for each shot and find where it falls within the cumulative probabilities, which gives the index of the basis state measured in that shot. The bits of the index are the states of the qubits (bit i is qubit i), which are stored in the classical bits of the measured qubits.
+        if terminalMeasurements:
+            probs = np.abs(self.state[:, 0]).astype(np.float64)**2
+            samples = np.searchsorted(np.cumsum(probs), self.rng.random(shots)*probs.sum())
+            samples = np.minimum(samples, len(probs)-1).astype(np.uint64)
+            measuredQubits = sorted({Qidx for gates in qubit_gates[firstMeasurePos:] for Qidx, gate in enumerate(gates) if gate == 'M'})
+            for Qidx in measuredQubits:
+                cbitStates[:, Qidx] = (samples >> np.uint64(Qidx)) & np.uint64(1)
+
+            # Leave the circuit in the post-measurement state of the last shot, as if it had been simulated: project onto the basis states that agree with the last shot's outcome for the measured qubits and normalize.
+            if measuredQubits and shots > 0:
+                measuredMask = sum(1 << Qidx for Qidx in measuredQubits)
+                indices = np.arange(len(probs))
+                keep = (indices & measuredMask) == (int(samples[-1]) & measuredMask)
+                self.state = np.where(keep[:, None], self.state, 0)
+                self.state = (self.state / np.sqrt(probs[keep].sum())).astype(self.dtype)
+
+        # Store the state of each classical bit for all shots.
+        for Bidx, cbit in enumerate(self.cbits):
+            cbit.state = cbitStates[:, Bidx]
+
+        # Pack the classical bit states of each shot into an integer (bit i is classical bit i). Only convert the unique integers into strings: a string containing the classical bit states at the end of the circuit, with bit 0 on the far right. Style the string as a ket since this is the state of the qubits, despite being stored in the classical bits.
+        resultInts = (cbitStates.astype(np.uint64) << np.arange(self.numCbits, dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+
+        # When there are no more possible outcomes than shots (or only a few), count each outcome with bincount, which is a single pass over the results instead of the sort done by np.unique. Make a table of the strings of every possible outcome, filled only for the outcomes that occurred, and look up each shot's string in it. Otherwise, the table would be larger than the results, so find the unique outcomes by sorting.
+        if (1 << self.numCbits) <= max(shots, 1 << 16):
+            resultInts = resultInts.astype(np.intp)
+            counts = np.bincount(resultInts, minlength=1 << self.numCbits)
+            uniqueInts = np.flatnonzero(counts)
+            counts = counts[uniqueInts]
+            labelTable = np.empty(1 << self.numCbits, dtype=object)
+            labelTable[uniqueInts] = ['|' + format(int(value), '0%ib'%self.numCbits) + '>' for value in uniqueInts]
+            labels = labelTable[uniqueInts]
+            results = labelTable[resultInts].tolist()
+        else:
+            uniqueInts, inverse, counts = np.unique(resultInts, return_inverse=True, return_counts=True)
+            labels = np.array(['|' + format(int(value), '0%ib'%self.numCbits) + '>' for value in uniqueInts], dtype=object)
+            results = labels[inverse].tolist()
 
         # If you want to create a histogram of your results:
         if hist:
+            import matplotlib.pyplot as plt
 
-            # Create a list 'labels' that contains each unique final circuit state within the list of all results. Get the number of times each unique state was obtained and store in the list 'counts'.
-            labels, counts = np.unique(results, return_counts=True)
+            # The unique final circuit states within the list of all results ('labels') and the number of times each unique state was obtained ('counts') were already found from the integers above, in increasing order, so the result strings do not need to be sorted again.
+            labels = labels.tolist()
 
             # Create a bar graph of the unique states with the number of counts of each state normalized to the total number of shots taken for the circuit. The bar graph thus gives the percent chance of obtaining each unique state.
             plt.bar(labels, counts/shots, align='center')
@@ -0,0 +1,105 @@
+# Tests for the circuit simulator: regression tests for controlled gates and SWAPs added after a mid-circuit measurement, and tests of unitary(), initialize(), and the seed and dtype options of Circuit. Run with python -m unittest test_Simulator.
+
+import unittest
+import numpy as np
+import Simulator as QPU
+
+class MeasurementPositionTests(unittest.TestCase):
+
+    # A CX on qubits above a measured qubit must not share the measurement's circuit position. Qubit 1 is flipped back to 0 by the CX, so every shot gives |101>.
+    def test_controlled_gate_after_measurement(self):
+        circuit = QPU.Circuit(3)
+        circuit.X([0, 1, 2])
+        circuit.measure(2)
+        circuit.CX([0], 1)
+        circuit.measure([0, 1])
+        self.assertEqual(set(circuit.run(100)), {'|101>'})
+
+    # Same as above, with a gate on the measured qubit after the CX. Every outcome is equally likely.
+    def test_controlled_gate_after_measurement_mixed(self):
+        circuit = QPU.Circuit(3, seed=1)
+        circuit.H([0, 1, 2])
+        circuit.measure(2)
+        circuit.CX([0], 1)
+        circuit.H(2)
+        circuit.measure([0, 1, 2])
+        results = circuit.run(8000)
+        for value in range(8):
+            self.assertAlmostEqual(results.count('|' + format(value, '03b') + '>')/8000, 1/8, delta=0.03)
+
+    # A SWAP on qubits above a measured qubit must not share the measurement's circuit position. Qubit 1 is swapped into qubit 0, so bit 0 is always 1.
+    def test_swap_after_measurement(self):
+        circuit = QPU.Circuit(3)
+        circuit.H(0)
+        circuit.X([1, 2])
+        circuit.measure(2)
+        circuit.SWAP(0, 1)
+        circuit.measure([0, 1])
+        self.assertEqual(set(circuit.run(2000)), {'|101>', '|111>'})
+
+    # A gate after a measurement means the circuit has no unitary matrix, even when it is on other qubits.
+    def test_unitary_gate_after_measurement(self):
+        circuit = QPU.Circuit(3)
+        circuit.X([0, 1, 2])
+        circuit.measure(2)
+        circuit.CX([0], 1)
+        with self.assertRaises(ValueError):
+            circuit.unitary()
+
+class CircuitOptionTests(unittest.TestCase):
+
+    # Add a few single qubit, controlled, and SWAP gates to a 3 qubit circuit.
+    def add_gates(self, circuit):
+        circuit.H(0)
+        circuit.RY(1, 0.7)
+        circuit.CX([0], 2)
+        circuit.CP([2], 1, 1.1)
+        circuit.SWAP(0, 1)
+        circuit.U(2, 0.3, 0.5, 0.9)
+        return circuit
+
+    # Column j of the unitary is the final state of the circuit when it starts in basis state j (qubit 0 is the least significant bit).
+    def test_unitary_matches_run(self):
+        circuit = self.add_gates(QPU.Circuit(3))
+        unitary = circuit.unitary()
+        for j in range(8):
+            circuit.initialize([[1, 0] if (j >> Qidx) & 1 == 0 else [0, 1] for Qidx in range(3)])
+            circuit.run(1)
+            np.testing.assert_allclose(circuit.state[:, 0], unitary[:, j], atol=1e-12)
+
+    # The circuit's state is the tensor product of the qubit states, with qubit 0 as the least significant bit. A state must be provided for every qubit.
+    def test_initialize(self):
+        circuit = QPU.Circuit(2)
+        circuit.initialize([[0, 1], [1/np.sqrt(2), 1/np.sqrt(2)]])
+        np.testing.assert_allclose(circuit.state[:, 0], [0, 1/np.sqrt(2), 0, 1/np.sqrt(2)])
+        with self.assertRaises(ValueError):
+            circuit.initialize([[1, 0]])
+
+    # Circuits with the same seed give the same measurement outcomes, for both terminal and mid-circuit measurements.
+    def test_seed_repeats(self):
+        def outcomes():
+            circuit = QPU.Circuit(3, seed=7)
+            circuit.H([0, 1, 2])
+            circuit.measure(0)
+            circuit.CX([0], 1)
+            circuit.H(0)
+            circuit.measure([0, 1, 2])
+            return circuit.run(200)
+        self.assertEqual(outcomes(), outcomes())
+
+    # A complex64 circuit keeps its state in complex64 through initialize() and run(), with or without mid-circuit measurements.
+    def test_complex64_state(self):
+        circuit = self.add_gates(QPU.Circuit(3, dtype=np.complex64))
+        circuit.initialize([[0, 1], [1, 0], [1, 0]])
+        self.assertEqual(circuit.state.dtype, np.complex64)
+        circuit.run(1)
+        self.assertEqual(circuit.state.dtype, np.complex64)
+        circuit.measure(0)
+        circuit.H(0)
+        circuit.run(10)
+        self.assertEqual(circuit.state.dtype, np.complex64)
+        with self.assertRaises(ValueError):
+            QPU.Circuit(3, dtype=np.float64)
+
+if __name__ == '__main__':
+    unittest.main()